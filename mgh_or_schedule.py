@@ -3,12 +3,36 @@
 """
 Take the clipboard contents copied from "My Cases" in Epic and produces a nicely
 formated table, which it saves to the copy/paste buffer to use in a spreadsheet
-software.
+software. Given files (or - for stdin) of "My Cases" data instead, several are
+tidied at once and their tables printed one after another.
 """
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from itertools import islice
+import os
 import re
+import sys
+import time
+
 import pyperclip
 
+# columns of the tidied table, in order
+columns = [
+    "Room",
+    "Time",
+    "Patient Name",
+    "Surgeons",
+    "Procedure",
+    "Patient Class",
+    "Residents/Fellows",
+]
+# rows at the start of "My Cases" data that are nonsense always
+junk_rows = 3
+preferred_name_re = re.compile(r"\".+?\" ")
+procedure_code_re = re.compile(r" \[\d+\]")
+room_re = re.compile(r"MGW")
+
 
 def tidy_patient_class(s):
     """Abbreviate patient class column."""
@@ -22,17 +46,17 @@ def tidy_patient_class(s):
 
 def tidy_patient_name(s):
     """Remove "preferred names" from names."""
-    return re.sub(r"\".+?\" ", "", s)
+    return preferred_name_re.sub("", s)
 
 
 def tidy_procedure(s):
     """Remove procedure code [NNNN] from procedure."""
-    return re.sub(r" \[\d+\]", "", s)
+    return procedure_code_re.sub("", s)
 
 
 def tidy_room(s):
     """Make MGW OR NN a more clear "WALTHMAM OR NN."""
-    return re.sub(r"MGW", "WALTHAM", s)
+    return room_re.sub("WALTHAM", s)
 
 
 def tidy_surgeons(s):
@@ -43,47 +67,49 @@ def tidy_surgeons(s):
     return "/".join([surg.split(",")[0] for surg in s.split("; ")])
 
 
-def fix_ms_data(dat):
+def extract_cases(dat):
     """
-    Takes a list of rows with multi-surgeon data and
-    returns a list with one case per row.
+    Takes lines of TSV copy data and yields the header then each case, in
+    order, as a TSV row, folding multi-surgeon cases' rows together as
+    they come.
     """
-    # rows are ["OR...", "Surg2...", "Surg3...", "OR...", ...]
-    # so join them together with "; ",
-    # sub in a \n at each new case (representated by "OR" (or "MGW OR"))
-    # then split the resultant string by the new \n to get one case per item
-    return re.sub(r"; ((MGW )?OR \d+)", r"\n\1", "; ".join(dat)).split("\n")
-
-
-def extract_cases(dat):
-    """ Takes a TSV copy data and returns a rows of cases."""
-    # ss = single surgeon; ms = multi-surgeon
-    ss_dat = []
-    ms_dat = []
-    # useful to see if rows aren't full length due to mult surgeons
-    ncols = 0
-    for n, row in enumerate(dat):
-        # add 1st row which is the headers
-        if n == 0:
-            ss_dat.append(row)
-            # 1st row always has correct length for a ss case, so set ncols off it
-            ncols = len(row.split("\t"))
+    lines = iter(dat)
+    header = next(lines, None)
+    if header is None:
+        return
+    yield header
+    # 1st row always has correct length for a ss case, so set ncols off it
+    # (ss = single surgeon; ms = multi-surgeon)
+    ncols = header.count("\t") + 1
+    # rows of the ms case being put back together, and its columns so far;
+    # when there are multi-surgeons, it copies and pastes them across
+    # multiple lines, like ["OR...\tSurg1...", "Surg2...", "Surg3...\t..."]
+    parts = []
+    nfields = 0
+    for row in lines:
         # skip blank rows
-        elif not row.strip():
+        if not row.strip():
             continue
-        # single surgeon rows always have correct number of items
-        elif len(row.split("\t")) == ncols:
-            ss_dat.append(row)
-        # add not fitting rows to the "multi-surgeon" list
-        # as when there are multi-surgeons, it copies and pastes them across
-        # multiple lines
-        else:
-            ms_dat.append(row)
-    return ss_dat + fix_ms_data(ms_dat)
+        fields = row.count("\t") + 1
+        # single surgeon rows always have correct number of items, so one
+        # can't carry on a case, which must have been cut short
+        if fields == ncols and parts:
+            yield "; ".join(parts)
+            parts, nfields = [], 0
+        # a carried on row's first column is the rest of the surgeons column
+        nfields += fields - 1 if parts else fields
+        parts.append(row)
+        if nfields >= ncols:
+            # join surgeons with "; " as they are in a ss case
+            yield "; ".join(parts)
+            parts, nfields = [], 0
+    if parts:
+        yield "; ".join(parts)
 
 
 def tidy(cases):
-    """Takes list of TSV cases and returns tidied list of case dicts."""
+    """Takes TSV cases (header first) and yields tidied cases, lists of
+    columns."""
     tidiers = {
         "Patient Class": tidy_patient_class,
         "Patient Name": tidy_patient_name,
@@ -93,46 +119,136 @@ def tidy(cases):
         "Surgeons": tidy_surgeons,
         "Time": str,
     }
-    tidied_cases = []
-    for row in csv.DictReader(cases, dialect="excel-tab"):
+    reader = csv.reader(cases, dialect="excel-tab")
+    header = next(reader, None)
+    if header is None:
+        return
+    # look up each column's place once, rather than per row
+    index = {name: i for i, name in enumerate(header)}
+    column_tidiers = [(index[c], tidiers[c]) for c in columns]
+    status = index["Progress Status"]
+    room = columns.index("Room")
+    for row in reader:
+        tidied_case = [tidier(row[i]) for i, tidier in column_tidiers]
         # Add on cases have no "OR NN" so make it "Add On"
-        if row["Progress Status"] == "Add On":
-            row["Room"] = "Add On"
-        tidied_case = {}
-        for k, v in row.items():
-            if k in tidiers:
-                tidied_case[k] = tidiers[k](v)
-        tidied_cases.append(tidied_case)
-    return tidied_cases
-
-
-def make_pastable_tsv(case_dicts):
-    """Takes case_dicts and outputs a sorted TSV to copy to a spreadsheet."""
-    columns = [
-        "Room",
-        "Time",
-        "Patient Name",
-        "Surgeons",
-        "Procedure",
-        "Patient Class",
-        "Residents/Fellows",
-    ]
+        if row[status] == "Add On":
+            tidied_case[room] = "Add On"
+        yield tidied_case
+
+
+def sort_cases(cases):
+    """Returns cases (lists of columns) sorted by room then time."""
+    room, start = columns.index("Room"), columns.index("Time")
+    return sorted(cases, key=lambda r: r[room] + r[start])
+
+
+def make_pastable_tsv(cases):
+    """Takes cases and outputs a sorted TSV to copy to a spreadsheet."""
     # add header
     tsv = ["\t".join(columns)]
     # add case rows
-    for r in sorted(case_dicts, key=lambda r: r["Room"] + r["Time"]):
-        tsv.append("\t".join(r[c] for c in columns))
+    for r in sort_cases(cases):
+        tsv.append("\t".join(r))
     return "\r\n".join(tsv)
 
 
+def tidy_lines(lines, skip=junk_rows):
+    """Returns sorted tidied cases from lines of "My Cases" data,
+    skipping the first skip lines."""
+    lines = (line.rstrip("\r\n") for line in islice(lines, skip, None))
+    return sort_cases(tidy(extract_cases(lines)))
+
+
+def tidy_file(filename, skip=junk_rows):
+    """Returns sorted tidied cases from filename of "My Cases" data,
+    read a line at a time, skipping the first skip lines."""
+    with open(filename, newline="") as f:
+        return tidy_lines(f, skip)
+
+
+def parser():
+    """Returns the command line parser."""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Tidies "My Cases" data from Epic into a table. Without FILEs, '
+            "it is taken from and put back into the clipboard, otherwise "
+            "the FILEs' tables are printed, one after another."
+        )
+    )
+    parser.add_argument(
+        "files",
+        metavar="FILE",
+        nargs="*",
+        help='file of "My Cases" data, - for stdin',
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of FILEs to tidy at once (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-s",
+        "--skip",
+        type=int,
+        default=junk_rows,
+        help=f"nonsense rows at the start of the data (default: {junk_rows})",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="store_true",
+        help="report how many rows per second were tidied on stderr",
+    )
+    return parser
+
+
+def tidy_files(files, skip=junk_rows, jobs=None):
+    """Yields the sorted tidied cases of each of files (- for stdin), in
+    order, tidying jobs files at once in separate processes."""
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # stdin can only be read from this process
+        futures = [
+            None if f == "-" else executor.submit(tidy_file, f, skip) for f in files
+        ]
+        for future in futures:
+            if future is None:
+                yield tidy_lines(sys.stdin, skip)
+            else:
+                yield future.result()
+
+
 def main():
-    """Take OR table clipboard contents, format nicely, & put into clipboard buffer."""
-    # take pasted input, with new rows represented with linebreaks, split it,
-    # and throw out first two rows as they are nonsense always
-    # ss_dat, ms_dat = extract_data(pyperclip.paste().split("\r\n")[2:])
-    cases = extract_cases(pyperclip.paste().splitlines()[3:])
-    tidied_case_dicts = tidy(cases)
-    pyperclip.copy(make_pastable_tsv(tidied_case_dicts))
+    """Take OR table clipboard contents, format nicely, & put into clipboard buffer,
+    or print the tables of the files given instead."""
+    args = parser().parse_args()
+    if args.jobs < 1:
+        sys.exit("JOBS must be at least 1.")
+    started = time.perf_counter()
+    nrows = 0
+    if not args.files:
+        # take pasted input, with new rows represented with linebreaks, split
+        # it, and throw out the first rows as they are nonsense always
+        cases = list(tidy(extract_cases(pyperclip.paste().splitlines()[args.skip :])))
+        nrows = len(cases)
+        pyperclip.copy(make_pastable_tsv(cases))
+    else:
+        try:
+            print("\t".join(columns))
+            for cases in tidy_files(args.files, args.skip, args.jobs):
+                nrows += len(cases)
+                for case in cases:
+                    print("\t".join(case))
+        except OSError as err:
+            sys.exit(f"{err.filename}: {err.strerror}")
+    if args.benchmark:
+        elapsed = time.perf_counter() - started
+        print(
+            f"Tidied {nrows} rows in {elapsed:.3f}s "
+            f"({nrows / elapsed:.0f} rows/s).",
+            file=sys.stderr,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+
+# benchmark.py,v1.0.0
+
+# Copyright (c) 2021 Thomas Ward <thomas@thomasward.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Benchmarks video_processor.py, vidinfo.py, and deidentify_videos.py on
+synthetic videos made with ffmpeg's lavfi testsrc, timing each stage
+without asking any questions, and saves the timings as json tagged with
+the git commit so runs can be compared. Also checks containers.py reads
+the videos' headers the same as ffprobe does. Requires ffprobe and ffmpeg
+installed, plus what the benchmarked scripts require.
+"""
+
+import argparse
+from datetime import datetime
+from functools import partial
+import json
+import os
+from pathlib import Path
+from shutil import rmtree, which
+from statistics import median
+import subprocess
+import struct
+import sys
+from tempfile import mkdtemp
+import time
+
+# the benchmarked scripts live next to this one
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import containers  # noqa: E402
+import deidentify_videos  # noqa: E402
+import video_processor  # noqa: E402
+import vidinfo  # noqa: E402
+
+# audio codec to go with each container
+audio_codecs = {"avi": "libmp3lame", "mkv": "aac", "mov": "aac", "mp4": "aac"}
+# test codecs that are an ffmpeg encoder at another frame rate or with
+# other options: encoder, frame rate, and its options
+codec_variants = {
+    # NTSC rate with B-frames, as cameras make, so edit lists and
+    # composition offsets don't line up with the movie timescale
+    "libx264_ntsc": ("libx264", "30000/1001", ["-preset", "veryfast", "-bf", "3"]),
+}
+stderr = partial(print, file=sys.stderr)
+# identifying text check_strip() hides in videos for stripping to remove
+marker = b"MRN123456-JohnDoeCam"
+
+
+def stderr_and_exit(*args, **kwargs):
+    """Print error message to stderr then exit."""
+    stderr(*args, **kwargs)
+    sys.exit(2)
+
+
+def comma_list(kind, value):
+    """Returns list of kind from comma separated value."""
+    return [kind(v) for v in value.split(",") if v]
+
+
+def parser():
+    """Returns an argparse parser."""
+    prsr = argparse.ArgumentParser(
+        description="Benchmark the video scripts on synthetic videos.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    prsr.add_argument(
+        "-d",
+        "--corpus",
+        default="benchmark_corpus",
+        help="Directory in which to make (or reuse) the test videos.",
+    )
+    prsr.add_argument(
+        "--lengths",
+        default="10,60",
+        type=partial(comma_list, int),
+        help="Comma separated lengths, in seconds, of test videos.",
+    )
+    prsr.add_argument(
+        "--codecs",
+        default="mpeg4,libx264,libx264_ntsc",
+        type=partial(comma_list, str),
+        help="Comma separated ffmpeg video encoders of test videos, or "
+        f"{', '.join(codec_variants)}.",
+    )
+    prsr.add_argument(
+        "--containers",
+        default="avi,mp4,mkv",
+        type=partial(comma_list, str),
+        help="Comma separated containers (extensions) of test videos.",
+    )
+    prsr.add_argument(
+        "--counts",
+        default="1,3",
+        type=partial(comma_list, int),
+        help="Comma separated numbers of videos per test directory.",
+    )
+    prsr.add_argument(
+        "--size", default="640x360", help="Width x height of test videos."
+    )
+    prsr.add_argument(
+        "--scan-files",
+        default=10000,
+        type=int,
+        help="Number of (empty) files in the directory scanning test tree.",
+    )
+    prsr.add_argument(
+        "-r",
+        "--repeats",
+        default=3,
+        type=int,
+        help="Times to run each stage (the median and min are reported).",
+    )
+    prsr.add_argument(
+        "-o",
+        "--output",
+        help="Output filename. If none provided, uses "
+        "benchmark_COMMIT_YYYYMMDDHHMM.json.",
+    )
+    prsr.add_argument(
+        "-c",
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Instead of benchmarking, compare the results in two output files.",
+    )
+    prsr.add_argument(
+        "-t",
+        "--threshold",
+        default=10,
+        type=float,
+        help="Percent change in median time to flag when comparing.",
+    )
+    return prsr
+
+
+def git_commit():
+    """
+    Returns the git commit of the scripts being benchmarked, with
+    "-dirty" appended if they have uncommitted changes, or "unknown".
+    """
+    git = ["git", "-C", os.path.dirname(os.path.abspath(__file__))]
+    try:
+        commit = video_processor.run(git + ["rev-parse", "--short", "HEAD"]).strip()
+        if video_processor.run(git + ["status", "--porcelain", "--", "."]).strip():
+            commit += "-dirty"
+        return commit
+    except (OSError, RuntimeError):
+        return "unknown"
+
+
+def ffmpeg_version():
+    """Returns the first line of ffmpeg -version."""
+    return subprocess.run(
+        ["ffmpeg", "-version"], stdout=subprocess.PIPE, check=True, encoding="utf-8"
+    ).stdout.splitlines()[0]
+
+
+def make_video(filename, length, codec, size, seed=0):
+    """
+    Makes a length second testsrc video, with a sine wave for audio and
+    some metadata to strip, encoded with codec (an encoder or one of
+    codec_variants). Same arguments give the same video.
+    """
+    container = os.path.splitext(filename)[1][1:]
+    options = ["-preset", "ultrafast"] if codec == "libx264" else ["-q:v", "5"]
+    encoder, rate, options = codec_variants.get(codec, (codec, "25", options))
+    video_processor.run(
+        ["ffmpeg", "-y"]
+        + ["-f", "lavfi", "-i", f"testsrc=duration={length}:size={size}:rate={rate}"]
+        # different tone per video so concat boundaries are audible
+        + ["-f", "lavfi", "-i", f"sine=frequency={440 + 110 * seed}:duration={length}"]
+        + ["-c:v", encoder, "-g", "50", "-pix_fmt", "yuv420p"]
+        + options
+        + ["-c:a", audio_codecs.get(container, "aac")]
+        # so repeated runs make identical files
+        + ["-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact"]
+        + ["-metadata", "title=benchmark", "-metadata", "comment=identifying"]
+        + [filename]
+    )
+
+
+def make_corpus(args):
+    """
+    Makes, in args.corpus, a directory of videos for every combination
+    of args' lengths, codecs, containers, and counts, skipping videos
+    already made. Returns list of dicts describing each directory.
+    """
+    cases = []
+    for length in args.lengths:
+        for codec in args.codecs:
+            for container in args.containers:
+                for count in args.counts:
+                    name = f"{codec}_{container}_{length}s_{count}x"
+                    directory = os.path.join(args.corpus, name)
+                    os.makedirs(directory, exist_ok=True)
+                    videos = []
+                    for n in range(count):
+                        video = os.path.join(directory, f"part{n}.{container}")
+                        if not os.path.exists(video):
+                            stderr(f"Making {video}")
+                            make_video(video, length, codec, args.size, n)
+                        videos.append(os.path.abspath(video))
+                    cases.append(
+                        {
+                            "case": name,
+                            "directory": os.path.abspath(directory),
+                            "videos": videos,
+                            "length": length * count,
+                            "bytes": sum(os.path.getsize(v) for v in videos),
+                        }
+                    )
+    return cases
+
+
+def make_scan_tree(directory, files, fanout=10):
+    """
+    Makes a tree of files empty files, alternately videos and not,
+    spread over directory and subdirectories fanout wide and 2 deep,
+    unless made already. Returns directory.
+    """
+    done = os.path.join(directory, ".done")
+    if os.path.exists(done):
+        return directory
+    for n in range(files):
+        subdir = [
+            directory,
+            os.path.join(directory, f"d{n % fanout}"),
+            os.path.join(directory, f"d{n % fanout}", f"d{n // fanout % fanout}"),
+        ][n % 3]
+        os.makedirs(subdir, exist_ok=True)
+        extension = ".mp4" if n % 2 else ".txt"
+        open(os.path.join(subdir, f"f{n}{extension}"), "w").close()
+    open(done, "w").close()
+    return directory
+
+
+def timed(func, repeats, setup=None, teardown=None):
+    """
+    Runs func repeats times (running setup before and teardown after,
+    untimed). Returns list of wall times in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+        if teardown is not None:
+            teardown()
+    return times
+
+
+def result(case, stage, times, input_bytes=None):
+    """Returns dict summarising the times a stage took on a case."""
+    res = {
+        "case": case,
+        "stage": stage,
+        "times": times,
+        "median": median(times),
+        "min": min(times),
+    }
+    if input_bytes:
+        res["throughput_mb_s"] = input_bytes / 1e6 / res["median"]
+    return res
+
+
+def clean(directory):
+    """Removes everything in directory."""
+    for f in os.listdir(directory):
+        path = os.path.join(directory, f)
+        if os.path.isdir(path):
+            rmtree(path)
+        else:
+            os.remove(path)
+
+
+def bench_stages(case, repeats, workdir):
+    """
+    Times each of video_processor's stages, stage by stage as the
+    original script ran them, plus ffprobe, on case. Returns list of
+    results.
+    """
+    vp = video_processor
+    videos = case["videos"]
+    name = case["case"]
+    extension = os.path.splitext(videos[0])[1]
+    out = partial(os.path.join, workdir)
+    results = [
+        result(
+            name,
+            "ffprobe",
+            timed(lambda: [vp.ffprobe(v) for v in videos], repeats),
+            case["bytes"],
+        ),
+        result(
+            name,
+            "vidinfo_ffprobe",
+            timed(
+                lambda: list(vidinfo.get_streams(case["directory"], headers=False)),
+                repeats,
+            ),
+            case["bytes"],
+        ),
+        result(
+            name,
+            "header_parse",
+            timed(lambda: [containers.parse(v) for v in videos], repeats),
+            case["bytes"],
+        ),
+        result(
+            name,
+            "vidinfo_headers",
+            timed(lambda: list(vidinfo.get_streams(case["directory"])), repeats),
+            case["bytes"],
+        ),
+    ]
+    # each stage reads the previous one's output, made once up front
+    concated = videos[0]
+    if len(videos) > 1:
+        concated = out("concat" + extension)
+        vp.concat(videos, concated, workdir)
+        results.append(
+            result(
+                name,
+                "concat",
+                timed(
+                    lambda: vp.concat(videos, out("timed" + extension), workdir),
+                    repeats,
+                    teardown=lambda: os.remove(out("timed" + extension)),
+                ),
+                case["bytes"],
+            )
+        )
+    trim_times = {"start": case["length"] / 4, "end": case["length"] * 3 / 4}
+    stages = [
+        ("trim", partial(vp.trim, trim_times=trim_times), extension),
+        ("remove_audio", vp.remove_audio, extension),
+        ("mp4", vp.mp4, ".mp4"),
+        ("strip_metadata", vp.strip_metadata, ".mp4"),
+    ]
+    infile = concated
+    for stage, func, stage_extension in stages:
+        if stage == "mp4" and extension == ".mp4":
+            continue
+        outfile = out(stage + stage_extension)
+        in_bytes = os.path.getsize(infile)
+        results.append(
+            result(
+                name,
+                stage,
+                timed(
+                    partial(func, infile, outfile),
+                    repeats,
+                    teardown=lambda outfile=outfile: os.remove(outfile),
+                ),
+                in_bytes,
+            )
+        )
+        func(infile, outfile)
+        infile = outfile
+    results.append(
+        result(
+            name,
+            "deidentify_strip_metadata",
+            timed(
+                lambda: [
+                    deidentify_videos.strip_metadata(v, Path(out(os.path.basename(v))))
+                    for v in videos
+                ],
+                repeats,
+                teardown=lambda: [os.remove(out(os.path.basename(v))) for v in videos],
+            ),
+            case["bytes"],
+        )
+    )
+    clean(workdir)
+    return results
+
+
+def bench_process_directory(case, repeats):
+    """
+    Times video_processor's whole (single pass) processing of case,
+    trimmed, as if run with no questions asked. Returns result.
+    """
+    vp = video_processor
+    args = vp.parser().parse_args(["-l", case["directory"]])
+    trim_times = {"start": case["length"] / 4, "end": case["length"] * 3 / 4}
+    final_videos = []
+    cwd = os.getcwd()
+    os.chdir(case["directory"])
+    try:
+        times = timed(
+            lambda: final_videos.append(
+                vp.process_directory(
+                    [os.path.basename(v) for v in case["videos"]], trim_times, args
+                )
+            ),
+            repeats,
+            teardown=lambda: os.remove(final_videos.pop()),
+        )
+    finally:
+        os.chdir(cwd)
+    return result(case["case"], "process_directory", times, case["bytes"])
+
+
+def bench_scan(directory, repeats):
+    """Times each script's way of finding videos in directory."""
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        times = timed(video_processor.directory_videos, repeats)
+    finally:
+        os.chdir(cwd)
+    return [
+        result("scan_tree", "video_processor_scan", times),
+        result(
+            "scan_tree",
+            "vidinfo_scan",
+            timed(lambda: list(vidinfo.video_files(directory, False)), repeats),
+        ),
+        result(
+            "scan_tree",
+            "deidentify_scan",
+            timed(lambda: deidentify_videos.get_video_paths(directory), repeats),
+        ),
+        result(
+            "scan_tree",
+            "deidentify_name",
+            timed(
+                lambda: dict(
+                    deidentify_videos.randomize_paths(
+                        deidentify_videos.get_video_paths(directory), "out", True
+                    )
+                ),
+                repeats,
+            ),
+        ),
+    ]
+
+
+def check_headers(cases):
+    """
+    Returns dict of how many of cases' videos containers.parse() read
+    the same as ffprobe, and the videos it fell back to ffprobe on or
+    read differently.
+    """
+    check = {"matched": 0, "fallbacks": [], "mismatches": []}
+    for video in sorted({v for case in cases for v in case["videos"]}):
+        parsed = containers.parse(video)
+        if parsed is None:
+            check["fallbacks"].append(video)
+        elif parsed == vidinfo.ffprobe(video):
+            check["matched"] += 1
+        else:
+            check["mismatches"].append(video)
+            stderr(f"Header parse of {video} differs from ffprobe's:\n{parsed}")
+    return check
+
+
+def mark_video(video, marked):
+    """
+    Copies MP4/MOV video to marked with marker as its tracks' handler
+    names and in free boxes at the end of its moov box and of the file.
+    Raises RuntimeError if the copy's moov box isn't last.
+    """
+    video_processor.run(
+        ["ffmpeg", "-y", "-i", video, "-map", "0", "-c", "copy"]
+        + ["-metadata:s", f"handler_name={marker.decode()}", marked]
+    )
+    with open(marked, "rb") as f:
+        data = bytearray(f.read())
+    kind, start, payload, end = list(containers.box_spans(data))[-1]
+    if kind != b"moov" or payload - start != 8:
+        raise RuntimeError(f"{marked} doesn't end with a moov box")
+    free = struct.pack(">I4s", 8 + len(marker), b"free") + marker
+    # the moov box is last, so growing it moves no samples
+    struct.pack_into(">I", data, start, end - start + len(free))
+    with open(marked, "wb") as f:
+        f.write(data + free + free)
+
+
+def check_strip(cases, workdir):
+    """
+    Returns dict of how many of cases' MP4/MOV videos, marked by
+    mark_video(), deidentify_videos.py stripped of the marker, and the
+    videos it couldn't strip in place (so used ffmpeg) or left the marker
+    in, as strings(1) would find it.
+    """
+    check = {"clean": 0, "fallbacks": [], "leaks": []}
+    videos = {v for case in cases for v in case["videos"]}
+    for video in sorted(v for v in videos if v.endswith((".mp4", ".mov"))):
+        ext = os.path.splitext(video)[1]
+        marked = os.path.join(workdir, "marked" + ext)
+        stripped = os.path.join(workdir, "stripped" + ext)
+        mark_video(video, marked)
+        if deidentify_videos.strip_mp4_in_place(marked, stripped) is None:
+            check["fallbacks"].append(video)
+            deidentify_videos.strip_metadata(marked, stripped)
+        with open(stripped, "rb") as f:
+            if marker in f.read():
+                check["leaks"].append(video)
+                stderr(f"Stripping a marked copy of {video} left {marker} in it.")
+            else:
+                check["clean"] += 1
+        clean(workdir)
+    return check
+
+
+def benchmark(args):
+    """Runs the benchmarks per args. Returns dict of the results."""
+    # nobody is watching, and progress lines would mix with our output
+    video_processor.show_progress_bar = False
+    cases = make_corpus(args)
+    scan_dir = make_scan_tree(os.path.join(args.corpus, "scan_tree"), args.scan_files)
+    results = []
+    workdir = mkdtemp(dir=args.corpus)
+    try:
+        for case in cases:
+            stderr(f"Benchmarking {case['case']}")
+            try:
+                results += bench_stages(case, args.repeats, workdir)
+                results.append(bench_process_directory(case, args.repeats))
+            except RuntimeError as err:
+                stderr(f"{case['case']} failed with:\n{err}")
+                clean(workdir)
+        strip_check = check_strip(cases, workdir)
+    finally:
+        rmtree(workdir)
+    results += bench_scan(scan_dir, args.repeats)
+    header_check = check_headers(cases)
+    stderr(
+        f"Header parse matched ffprobe on {header_check['matched']} videos, fell "
+        f"back on {len(header_check['fallbacks'])}, and differed on "
+        f"{len(header_check['mismatches'])}."
+    )
+    stderr(
+        f"Stripping removed the marker from {strip_check['clean']} videos "
+        f"({len(strip_check['fallbacks'])} with ffmpeg), and left it in "
+        f"{len(strip_check['leaks'])}."
+    )
+    return {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "ffmpeg": ffmpeg_version(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "cases": [{k: v for k, v in c.items() if k != "videos"} for c in cases],
+        "results": results,
+        "header_check": header_check,
+        "strip_check": strip_check,
+    }
+
+
+def compare(old_filename, new_filename, threshold=10):
+    """
+    Prints, for each case and stage in both benchmark outputs, the
+    median times and percent change, flagging changes over threshold.
+    """
+    with open(old_filename) as old_file, open(new_filename) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    old_medians = {(r["case"], r["stage"]): r["median"] for r in old["results"]}
+    print(f"{'case':<28} {'stage':<26} {old['commit']:>10} {new['commit']:>10} change")
+    for res in new["results"]:
+        key = (res["case"], res["stage"])
+        if key not in old_medians:
+            continue
+        change = (res["median"] - old_medians[key]) / old_medians[key] * 100
+        flag = ""
+        if change > threshold:
+            flag = " slower"
+        elif change < -threshold:
+            flag = " faster"
+        print(
+            f"{key[0]:<28} {key[1]:<26} {old_medians[key]:>10.4f} "
+            f"{res['median']:>10.4f} {change:+6.1f}%{flag}"
+        )
+
+
+def main():
+    """Benchmarks the video scripts, or compares two benchmarks."""
+    args = parser().parse_args()
+    if args.compare is not None:
+        compare(*args.compare, args.threshold)
+        return
+    if args.repeats < 1:
+        stderr_and_exit("Need at least one repeat. Exiting.")
+    os.makedirs(args.corpus, exist_ok=True)
+    results = benchmark(args)
+    output = args.output
+    if output is None:
+        output = f"benchmark_{results['commit']}_{datetime.now():%Y%m%d%H%M}.json"
+    video_processor.save_json(results, output)
+    print(f'Benchmark results saved as "{output}".')
+
+
+if __name__ == "__main__":
+    if not which("ffprobe"):
+        stderr_and_exit("ffprobe not found")
+    if not which("ffmpeg"):
+        stderr_and_exit("ffmpeg not found")
+    main()
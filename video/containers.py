@@ -0,0 +1,388 @@
+# containers.py,v1.0.0
+
+# Copyright (c) 2021 Thomas Ward <thomas@thomasward.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Reads the codec, width, and height of each video stream, and the
+container's format name and duration, from the headers of MP4/MOV and
+AVI files without running ffprobe. Returns them shaped like vidinfo.py's
+ffprobe output, or None for anything it cannot read with confidence so
+the caller can fall back to ffprobe.
+"""
+
+import math
+import struct
+
+# biggest moov box/AVI header list read into memory
+max_header = 64 * 1024 * 1024
+# MP4 sample entry type to ffprobe codec name
+mp4_codecs = {
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hev1": "hevc",
+    b"hvc1": "hevc",
+    b"av01": "av1",
+    b"vp09": "vp9",
+}
+# MPEG-4 systems object type indication (in esds) to ffprobe codec name
+mp4_object_types = {0x20: "mpeg4", 0x6C: "mjpeg"}
+# AVI BITMAPINFOHEADER compression (upper cased) to ffprobe codec name
+avi_codecs = {
+    b"FMP4": "mpeg4",
+    b"XVID": "mpeg4",
+    b"DIVX": "mpeg4",
+    b"DX50": "mpeg4",
+    b"MP4V": "mpeg4",
+    b"H264": "h264",
+    b"X264": "h264",
+    b"AVC1": "h264",
+    b"MJPG": "mjpeg",
+    b"MP42": "msmpeg4v2",
+    b"MP43": "msmpeg4v3",
+    b"DIV3": "msmpeg4v3",
+}
+
+
+def box_spans(data, start=0, end=None):
+    """
+    Yields tuples of type, start, payload start, and end of the MP4
+    boxes in data between start and end. Raises ValueError if malformed.
+    """
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f"bad {kind} box size")
+        yield (kind, pos, pos + header, pos + size)
+        pos += size
+
+
+def boxes(data, start=0, end=None):
+    """
+    Yields tuples of type, payload start, and payload end of the MP4
+    boxes in data between start and end. Raises ValueError if malformed.
+    """
+    for kind, _, payload_start, box_end in box_spans(data, start, end):
+        yield (kind, payload_start, box_end)
+
+
+def child(data, start, end, kind):
+    """Returns tuple of the payload start and end of 1st kind box, or None."""
+    for box, box_start, box_end in boxes(data, start, end):
+        if box == kind:
+            return (box_start, box_end)
+    return None
+
+
+def descriptor(data, pos):
+    """Returns tuple of tag, payload start, and payload end of descriptor."""
+    tag = data[pos]
+    length = 0
+    pos += 1
+    # up to 4 bytes of 7 bit length, high bit set if more follow
+    for _ in range(4):
+        length = (length << 7) | (data[pos] & 0x7F)
+        pos += 1
+        if not data[pos - 1] & 0x80:
+            break
+    return (tag, pos, pos + length)
+
+
+def esds_codec(data, start, end):
+    """Returns codec name from the object type in an esds box, or None."""
+    tag, pos, _ = descriptor(data, start + 4)
+    if tag != 0x03:
+        return None
+    flags = data[pos + 2]
+    # skip ES_ID, flags, and the optional fields they flag
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + data[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, _ = descriptor(data, pos)
+    if tag != 0x04:
+        return None
+    return mp4_object_types.get(data[pos])
+
+
+def full_box_version(data, start):
+    """Returns version of the full box with payload starting at start."""
+    return data[start]
+
+
+def track_timing(data, start, end, movie_timescale):
+    """
+    Returns tuple of start and end times, in microseconds, of the trak
+    box between start and end, as ffmpeg works them out from its edit
+    list (in units of movie_timescale), or None if unsure.
+    """
+    mdia = child(data, start, end, b"mdia")
+    mdhd = mdia and child(data, *mdia, b"mdhd")
+    if mdhd is None:
+        return None
+    if full_box_version(data, mdhd[0]) == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, mdhd[0] + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, mdhd[0] + 12)
+    if not timescale:
+        return None
+    stbl = child(data, *mdia, b"minf")
+    stbl = stbl and child(data, *stbl, b"stbl")
+    ctts = stbl and child(data, *stbl, b"ctts")
+    stts = stbl and child(data, *stbl, b"stts")
+    # ffmpeg trusts the sample durations over mdhd when they add up to less
+    if stts is not None:
+        count = struct.unpack_from(">I", data, stts[0] + 4)[0]
+        runs = struct.unpack_from(">%dI" % (2 * count), data, stts[0] + 8)
+        duration = min(
+            duration, sum(n * delta for n, delta in zip(runs[::2], runs[1::2]))
+        )
+    # presentation times start at the 1st sample's composition offset
+    first_offset = 0
+    if ctts is not None and struct.unpack_from(">I", data, ctts[0] + 4)[0]:
+        first_offset = struct.unpack_from(">i", data, ctts[0] + 12)[0]
+    edits = []
+    edts = child(data, start, end, b"edts")
+    elst = edts and child(data, *edts, b"elst")
+    if elst is not None:
+        version = full_box_version(data, elst[0])
+        count = struct.unpack_from(">I", data, elst[0] + 4)[0]
+        fmt, entry_size = (">Qqhh", 20) if version == 1 else (">Iihh", 12)
+        edits = [
+            struct.unpack_from(fmt, data, elst[0] + 8 + i * entry_size)
+            for i in range(count)
+        ]
+    # leading empty edits delay the track
+    empty = 0
+    while edits and edits[0][1] == -1:
+        empty += edits.pop(0)[0]
+    track_start = round(empty * timescale / movie_timescale)
+    if not edits:
+        track_duration = duration
+    elif len(edits) == 1 and edits[0][2:] == (1, 0):
+        segment, media_time = edits[0][:2]
+        segment = round(segment * timescale / movie_timescale)
+        # ffmpeg counts the edit from the 1st presented sample's decode time
+        track_duration = min(duration, segment + first_offset)
+        # unsure unless the edit runs to the end of the media, give or take
+        # a tick of the movie timescale that segment was rounded to
+        tolerance = math.ceil(timescale / movie_timescale)
+        overlap = duration + first_offset - media_time
+        if media_time > 0 and abs(segment - overlap) > tolerance:
+            return None
+    else:
+        return None
+    if track_duration <= 0:
+        return None
+    start_us = round(track_start * 1e6 / timescale)
+    return (start_us, start_us + round(track_duration * 1e6 / timescale))
+
+
+def mp4_stream(data, start, end):
+    """
+    Returns dict of codec, width, and height of the video trak box
+    between start and end, {} if not a video track, or None if unsure.
+    """
+    mdia = child(data, start, end, b"mdia")
+    hdlr = mdia and child(data, *mdia, b"hdlr")
+    if hdlr is None:
+        return None
+    if data[hdlr[0] + 8 : hdlr[0] + 12] != b"vide":
+        return {}
+    stbl = child(data, *mdia, b"minf")
+    stbl = stbl and child(data, *stbl, b"stbl")
+    stsd = stbl and child(data, *stbl, b"stsd")
+    if stsd is None or struct.unpack_from(">I", data, stsd[0] + 4)[0] != 1:
+        return None
+    entries = list(boxes(data, stsd[0] + 8, stsd[1]))
+    if len(entries) != 1:
+        return None
+    kind, entry_start, entry_end = entries[0]
+    codec = mp4_codecs.get(kind)
+    if kind == b"mp4v":
+        # children follow the 78 bytes of the visual sample entry
+        esds = child(data, entry_start + 78, entry_end, b"esds")
+        codec = esds and esds_codec(data, *esds)
+    if codec is None:
+        return None
+    width, height = struct.unpack_from(">HH", data, entry_start + 24)
+    return {"codec_name": codec, "width": width, "height": height}
+
+
+def parse_mp4(f, size):
+    """
+    Returns tuple of list of video streams and duration read from MP4
+    file object f, of size bytes, or None if unsure.
+    """
+    pos = 0
+    moov = None
+    # top level boxes, seeking past the (big) media data to the moov box
+    while pos + 8 <= size:
+        f.seek(pos)
+        header = f.read(16)
+        box_size, kind = struct.unpack_from(">I4s", header)
+        if box_size == 1:
+            box_size = struct.unpack_from(">Q", header, 8)[0]
+        elif box_size == 0:
+            box_size = size - pos
+        if box_size < 8:
+            return None
+        if kind == b"moov":
+            if box_size > max_header:
+                return None
+            f.seek(pos)
+            moov = f.read(box_size)
+            break
+        # fragmented mp4s need every fragment read for their duration
+        if kind == b"moof":
+            return None
+        pos += box_size
+    if moov is None or len(moov) != box_size:
+        return None
+    _, moov_start, moov_end = next(boxes(moov))
+    mvhd = child(moov, moov_start, moov_end, b"mvhd")
+    if mvhd is None or child(moov, moov_start, moov_end, b"mvex"):
+        return None
+    if full_box_version(moov, mvhd[0]) == 1:
+        movie_timescale = struct.unpack_from(">I", moov, mvhd[0] + 20)[0]
+    else:
+        movie_timescale = struct.unpack_from(">I", moov, mvhd[0] + 12)[0]
+    if not movie_timescale:
+        return None
+    streams = []
+    timings = []
+    for kind, start, end in boxes(moov, moov_start, moov_end):
+        if kind != b"trak":
+            continue
+        stream = mp4_stream(moov, start, end)
+        timing = track_timing(moov, start, end, movie_timescale)
+        if stream is None or timing is None:
+            return None
+        if stream:
+            streams.append(stream)
+        timings.append(timing)
+    if not timings:
+        return None
+    # like ffmpeg, from the earliest track start to the latest track end
+    start_us = min(t[0] for t in timings)
+    end_us = max(t[1] for t in timings)
+    return (streams, (end_us - start_us) / 1e6)
+
+
+def riff_chunks(data, start, end):
+    """
+    Yields tuples of id (the list type for LIST chunks), payload start,
+    and payload end of the RIFF chunks in data between start and end.
+    """
+    pos = start
+    while pos + 8 <= end:
+        chunk_id, size = struct.unpack_from("<4sI", data, pos)
+        payload = pos + 8
+        if chunk_id == b"LIST":
+            chunk_id = bytes(data[payload : payload + 4])
+            payload += 4
+        if pos + 8 + size > end:
+            raise ValueError(f"bad {chunk_id} chunk size")
+        yield (chunk_id, payload, pos + 8 + size)
+        # chunks are padded to an even size
+        pos += 8 + size + (size & 1)
+
+
+def parse_avi(f, size):
+    """
+    Returns tuple of list of video streams and duration read from AVI
+    file object f, of size bytes, or None if unsure.
+    """
+    f.seek(0)
+    header = f.read(24)
+    if len(header) < 24 or header[:4] != b"RIFF" or header[8:12] != b"AVI ":
+        return None
+    # the header list is the first chunk of the first RIFF
+    list_id, hdrl_size, list_type = struct.unpack_from("<4sI4s", header, 12)
+    if list_id != b"LIST" or list_type != b"hdrl" or hdrl_size > max_header:
+        return None
+    f.seek(12)
+    hdrl = f.read(8 + hdrl_size)
+    streams = []
+    duration = 0
+    for chunk_id, start, end in riff_chunks(hdrl, 12, len(hdrl)):
+        # OpenDML (>1 GB) files can have frames past the 1st RIFF's counts
+        if chunk_id == b"odml":
+            return None
+        if chunk_id != b"strl":
+            continue
+        strl = {c: (s, e) for c, s, e in riff_chunks(hdrl, start, end)}
+        if b"strh" not in strl or b"strf" not in strl:
+            return None
+        strh = strl[b"strh"][0]
+        kind = hdrl[strh : strh + 4]
+        scale, rate, stream_start, length = struct.unpack_from("<IIII", hdrl, strh + 20)
+        if not scale or not rate:
+            return None
+        # the longest stream, e.g. audio, sets the duration
+        duration = max(duration, (stream_start + length) * scale / rate)
+        if kind != b"vids":
+            continue
+        strf = strl[b"strf"][0]
+        width, height = struct.unpack_from("<ii", hdrl, strf + 4)
+        codec = avi_codecs.get(bytes(hdrl[strf + 16 : strf + 20]).upper())
+        if codec is None:
+            return None
+        streams.append({"codec_name": codec, "width": width, "height": abs(height)})
+    if not streams:
+        return None
+    return (streams, duration)
+
+
+def parse(filename):
+    """
+    Returns dict, shaped like vidinfo.py's ffprobe output, of filename's
+    video streams and format read from its headers, or None if it is not
+    an MP4/MOV or AVI file this can read with confidence.
+    """
+    try:
+        with open(filename, "rb") as f:
+            magic = f.read(12)
+            size = f.seek(0, 2)
+            if magic[:4] == b"RIFF":
+                parsed, format_name = parse_avi(f, size), "avi"
+            elif magic[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide"):
+                parsed, format_name = parse_mp4(f, size), "mov,mp4,m4a,3gp,3g2,mj2"
+            else:
+                return None
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+    if parsed is None:
+        return None
+    streams, duration = parsed
+    return {
+        "programs": [],
+        "streams": streams,
+        "format": {
+            "filename": filename,
+            "format_name": format_name,
+            "duration": f"{duration:.6f}",
+        },
+    }
@@ -22,12 +22,22 @@ them with either a random UUID or sequentially named file (e.g.
 video001.mp4, video002.mp4...videoNNN.mp4) then stripping excessive
 metadata from the video file. A CSV file to translate video filename to
 randomized filename is saved to deidentify_YYYYMMDDHHMM.log by default
-(filled in with the date-time) or a user-specified LOGFILE. Requires
-Python 3.6+, docopt python package, and ffmpeg installed.
+(filled in with the date-time) or a user-specified LOGFILE. Several
+videos are stripped at once, largest first, and any that fail are
+listed at the end. Progress is journaled next to LOGFILE so an
+interrupted run can be finished with --resume given the same LOGFILE. Identical copies of a video can be
+stripped just once. OUTDIR can be split into levels of subdirectories
+named by hex prefixes of the new filenames, and --lookup finds a
+filename's video in it. The csv holds the SHA-256 of each video before
+and after, which --verify checks. Requires Python 3.6+, docopt python package,
+and ffmpeg installed.
 
 Usage:
-    deidentify_videos.py [-l LOGFILE] [-s] INDIR OUTDIR
-    deidentify_videos.py [-l LOGFILE] [-m] INDIR OUTDIR
+    deidentify_videos.py [-l LOGFILE] [-s] [-j JOBS] [-d MODE] [-L LEVELS] [-f N] INDIR OUTDIR
+    deidentify_videos.py [-l LOGFILE] [-m] [-j JOBS] [-d MODE] [-L LEVELS] [-f N] INDIR OUTDIR
+    deidentify_videos.py -l LOGFILE [-j JOBS] --resume INDIR OUTDIR
+    deidentify_videos.py --lookup OUTDIR NAME...
+    deidentify_videos.py [-j JOBS] --verify CSVFILE
     deidentify_videos.py -h
 
 Options:
@@ -35,38 +45,106 @@ Options:
     -l LOGFILE  User-specified file to write a csv of old,new filenames.
     -s          Output sequential videoNNN rather than uuid filenames.
     -m          Only strip metadata; do not randomize filenames.
+    -j JOBS     Number of videos to strip (or verify) at once [default: 4].
+    -d MODE     Strip identical copies of a video once, making the other
+                copies either a hardlink or reflink (MODE) to it in
+                OUTDIR, or (alias) listing them in the csv as it.
+    -L LEVELS   Levels of subdirectories to spread videos over in
+                OUTDIR [default: 0].
+    -f N        Subdirectories in each level, 16, 256, or 4096
+                [default: 256].
+    --resume    Finish an interrupted run into OUTDIR, that wrote
+                LOGFILE, keeping its filenames and skipping videos
+                already done.
+    --lookup    Print the paths in OUTDIR of the videos named NAME.
+    --verify    Check the videos in CSVFILE, a csv written by a run,
+                still have the checksums it recorded.
 
 Arguments:
     INDIR       Directory containing videos.
     OUTDIR      Directory in which to place de-identified videos.
+    NAME        New filename of a video (e.g. from the csv).
+    CSVFILE     The csv of old,new filenames a run wrote.
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import logging
+import csv
+import hashlib
+import json
+import mmap
 from math import floor, log10
+import os
 from pathlib import Path
 import secrets
+import shutil
+import struct
 import subprocess
 import sys
+import threading
 from uuid import uuid4
 
 from docopt import docopt
 
+import containers
+import walker
 
-def setup_log(log_filename=None):
-    """Creates a log file to record original to randomized video names.
-    If no filename is specified, will create a log file named
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(2) to share a file's blocks with another (a reflink), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+# MP4 boxes holding nothing but other boxes, searched for metadata
+mp4_containers = (b"moov", b"trak", b"mdia", b"minf")
+# MP4 boxes of user data (titles, locations, chapters, XMP, etc.), or
+# padding, which can hold anything
+metadata_boxes = (b"udta", b"meta", b"uuid", b"free", b"skip", b"wide")
+# top level MP4 boxes kept, ffmpeg wouldn't copy the others
+toplevel_boxes = (b"ftyp", b"moov", b"mdat")
+# names ffmpeg gives handlers (of track types) when not copying metadata
+handler_names = {b"vide": b"VideoHandler", b"soun": b"SoundHandler"}
+# added to LOGFILE's name for the journal of a run's filenames and
+# finished videos, kept with it as both name the original videos
+journal_suffix = ".journal.jsonl"
+# bytes from the start, middle, and end of a video hashed by quick_checksum()
+checksum_bytes = 1024 * 1024
+# ways to make copies of duplicate videos in OUTDIR
+duplicate_modes = ("hardlink", "reflink", "alias")
+# bytes hashed at a time by sha256_file() and sha256_patched()
+hash_bytes = 16 * 1024 * 1024
+# bytes of the csv log held in memory between writes
+log_buffer = 1024 * 1024
+# how OUTDIR is split into subdirectories, kept in OUTDIR for --lookup
+layout_name = ".deidentify_layout.json"
+# subdirectories per level of OUTDIR allowed, to hex digits naming them
+fanouts = {16: 1, 256: 2, 4096: 3}
+# most levels of subdirectories, so uuids have enough hex digits to go round
+max_levels = 4
+
+
+def log_name(log_filename=None):
+    """Returns log_filename, or if it is None, a default log filename
     'deidentify_log_YYYYMMDDHHMM.csv'"""
 
     if log_filename is None:
         log_filename = (
             "deidentify_log_" + datetime.now().strftime("%Y%m%d%H%M") + ".csv"
         )
-    # over-writes pre-existing file rather than appending to an old one
-    logging.basicConfig(
-        filename=log_filename, filemode="w", level=logging.INFO, format="%(message)s"
+    return log_filename
+
+
+def setup_log(log_filename):
+    """Creates a log file to record original to randomized video names,
+    returning it open with its CSV header written."""
+
+    # over-writes pre-existing file rather than appending to an old one,
+    # buffered as there can be millions of rows
+    log_file = open(log_filename, "w", newline="", buffering=log_buffer)
+    csv.writer(log_file).writerow(
+        ["original", "randomized", "original_sha256", "randomized_sha256"]
     )
-    # write CSV header
-    logging.info("%s,%s", "original", "randomized")
+    return log_file
 
 
 def name_generator(uuid=False, prefix="", start=0, width=3):
@@ -101,54 +179,363 @@ def seq_width(num):
     return floor(log10(num)) + 1
 
 
-def shuffle(some_list):
-    """Returns the items in some_list in shuffled order."""
-    # do a defensive copy so that the original list doesn't get
-    # consumed by the 'pop()'
-    items = some_list.copy()
-    while items:
-        yield items.pop(secrets.randbelow(len(items)))
+def shard_dirs(name, levels=0, width=2):
+    """Returns list of the levels subdirectories, each named by width
+    hex digits, that filename name goes in. They are taken from the
+    start of a uuid name, the end of a sequential name's number (so
+    consecutive videos are spread out), or else a hash of name."""
+    stem = os.path.splitext(name)[0]
+    if stem.startswith("video") and stem[5:].isdigit():
+        n = int(stem[5:])
+        fanout = 16**width
+        return [f"{n // fanout**i % fanout:0{width}x}" for i in range(levels)]
+    if len(stem) == 32 and all(c in "0123456789abcdef" for c in stem):
+        digits = stem
+    else:
+        digits = hashlib.blake2b(stem.encode()).hexdigest()
+    return [digits[i * width : (i + 1) * width] for i in range(levels)]
+
+
+def output_path(outdir, name, levels=0, width=2):
+    """Returns path of filename name in outdir, split into levels
+    subdirectories with width hex digit names."""
+    return os.path.join(outdir, *shard_dirs(name, levels, width), name)
+
+
+def write_layout(outdir, levels, width):
+    """Saves how outdir is split into subdirectories for lookup()."""
+    with open(os.path.join(outdir, layout_name), "w") as f:
+        json.dump({"levels": levels, "width": width}, f)
 
 
-def randomize_paths(vid_paths, outdir, sequentialize):
-    """Returns a dict of orig_name: random_name. When sequentialize is
-    true, random_names will be like video000, video001, etc, otherwise
-    returns a uuid4."""
+def lookup(outdir, name):
+    """Returns path of the video named name (e.g. from the csv log) in
+    outdir, from its layout rather than searching outdir, or None if
+    there isn't one."""
+    try:
+        with open(os.path.join(outdir, layout_name)) as f:
+            layout = json.load(f)
+    except FileNotFoundError:
+        # made before outdir could be split into subdirectories
+        layout = {"levels": 0, "width": 2}
+    name = os.path.basename(name)
+    path = output_path(outdir, name, layout["levels"], layout["width"])
+    return path if os.path.isfile(path) else None
+
+
+def shuffle(items):
+    """Shuffles list items in place (a Fisher-Yates shuffle, with
+    secrets so the order can't be predicted) and returns it."""
+    for i in range(len(items) - 1, 0, -1):
+        j = secrets.randbelow(i + 1)
+        items[i], items[j] = items[j], items[i]
+    return items
+
+
+def randomize_paths(vid_paths, outdir, sequentialize, levels=0, width=2):
+    """Yields tuples of orig_name, random_name for vid_paths, a list
+    which is shuffled in place. When sequentialize is true, random_names
+    will be like video000, video001, etc, otherwise returns a uuid4.
+    random_names are split into levels subdirectories of outdir, see
+    shard_dirs()."""
     if sequentialize:
         generate_name = name_generator(prefix="video", width=seq_width(len(vid_paths)))
     else:
         generate_name = name_generator(uuid=True)
-    orig_to_random = {}
     # shuffle the filenames so that sequentially generated filenames
     # don't mimic the order of the filenames in the input directory
     for orig_path in shuffle(vid_paths):
-        randomized_path = Path(outdir).joinpath(generate_name() + orig_path.suffix)
-        orig_to_random[orig_path] = randomized_path
+        extension = os.path.splitext(orig_path)[1]
+        name = generate_name() + extension
+        yield (orig_path, output_path(outdir, name, levels, width))
 
-    return orig_to_random
 
+def transpose_paths(paths, outdir, levels=0, width=2):
+    """Yields tuples of each path in paths and the path from joining
+    outdir (split into levels subdirectories, see shard_dirs()) with
+    the basename of path."""
+    for path in paths:
+        yield (path, output_path(outdir, os.path.basename(path), levels, width))
 
-def transpose_paths(paths, outdir):
-    """Returns dict mapping each path in paths to a path from joining
-    outdir with the basename of path."""
-    return {path: Path(outdir).joinpath(path.name) for path in paths}
 
-
-def is_video_path(path):
-    """Checks if path has a video extension and is a file."""
+def get_video_paths(vid_dir):
+    """Returns list of paths (strings, which take much less memory than
+    Paths) of files with video extensions in vid_dir"""
     vid_exts = (".mp4", ".avi")
-    return path.suffix.casefold() in vid_exts and path.is_file()
+    return list(walker.walk(vid_dir, vid_exts))
 
 
-def get_video_paths(vid_dir):
-    """Yield files with video extensions in vid_dir"""
-    return [path for path in Path(vid_dir).rglob("*") if is_video_path(path)]
+def clone_file(src, dst):
+    """Copies src to dst, sharing src's blocks (a reflink) if the
+    filesystem can, else with copy_file_range so the kernel does the
+    copying (in the filesystem or storage, if it can)."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+        size = os.fstat(fsrc.fileno()).st_size
+        try:
+            while fsrc.tell() < size:
+                if not os.copy_file_range(fsrc.fileno(), fdst.fileno(), size):
+                    break
+            if fsrc.tell() == size:
+                return
+        except (AttributeError, OSError):
+            pass
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def free_box(size, header_size=8):
+    """Returns bytes of a free box, filled with zeros, of size bytes
+    with a header_size (8 or 16) byte header."""
+    if header_size == 16:
+        header = struct.pack(">I4sQ", 1, b"free", size)
+    else:
+        header = struct.pack(">I4s", size, b"free")
+    return header + bytes(size - header_size)
+
+
+def chapter_tracks(data, start, end):
+    """Returns set of IDs of the chapter tracks referred to by the trak
+    boxes of data, an MP4 moov box, between start and end."""
+    ids = set()
+    for trak in containers.boxes(data, start, end):
+        if trak[0] != b"trak":
+            continue
+        tref = containers.child(data, *trak[1:], b"tref")
+        chap = tref and containers.child(data, *tref, b"chap")
+        if chap is not None:
+            ids.update(
+                struct.unpack_from(f">{(chap[1] - chap[0]) // 4}I", data, chap[0])
+            )
+    return ids
+
+
+def sample_ranges(data, start, end):
+    """Yields tuples of file offset and size of each sample of the stbl
+    box of data between start and end."""
+    stsz = containers.child(data, start, end, b"stsz")
+    stsc = containers.child(data, start, end, b"stsc")
+    stco = containers.child(data, start, end, b"stco")
+    co64 = containers.child(data, start, end, b"co64")
+    if stsz is None or stsc is None or (stco or co64) is None:
+        raise ValueError("stbl without sample sizes or locations")
+    size, count = struct.unpack_from(">II", data, stsz[0] + 4)
+    sizes = [size] * count
+    if not size:
+        sizes = struct.unpack_from(f">{count}I", data, stsz[0] + 12)
+    if stco is not None:
+        chunks = struct.unpack_from(">I", data, stco[0] + 4)[0]
+        offsets = struct.unpack_from(f">{chunks}I", data, stco[0] + 8)
+    else:
+        chunks = struct.unpack_from(">I", data, co64[0] + 4)[0]
+        offsets = struct.unpack_from(f">{chunks}Q", data, co64[0] + 8)
+    entries = struct.unpack_from(">I", data, stsc[0] + 4)[0]
+    # runs of chunks, from first_chunk, with the same number of samples
+    runs = [
+        struct.unpack_from(">II", data, stsc[0] + 8 + i * 12) for i in range(entries)
+    ]
+    sample = 0
+    for chunk, offset in enumerate(offsets, 1):
+        per_chunk = [n for first, n in runs if first <= chunk][-1]
+        for size in sizes[sample : sample + per_chunk]:
+            yield (offset, size)
+            offset += size
+        sample += per_chunk
+
+
+def strip_compressor_names(data, mdia):
+    """Zeros the compressor (encoder) names of the visual sample entries
+    of the mdia box of data spanning mdia (payload start and end)."""
+    stbl = containers.child(data, *mdia, b"minf")
+    stbl = stbl and containers.child(data, *stbl, b"stbl")
+    stsd = stbl and containers.child(data, *stbl, b"stsd")
+    if stsd is None:
+        raise ValueError("video trak without stsd")
+    for _, entry_start, entry_end in containers.boxes(data, stsd[0] + 8, stsd[1]):
+        # the 32 byte name follows the 42 bytes before it in the entry
+        if entry_end - entry_start >= 74:
+            data[entry_start + 42 : entry_start + 74] = bytes(32)
+
+
+def strip_handler_name(data, payload, end, mov=False):
+    """Overwrites the name of the hdlr box of data spanning payload to
+    end with the one ffmpeg gives its handler type, as a MOV's Pascal
+    string if mov, else a C string. Raises ValueError if it won't fit
+    so it reads back the same."""
+    name = handler_names.get(bytes(data[payload + 8 : payload + 12]), b"DataHandler")
+    size = end - payload - 24
+    if mov and size == len(name) + 1:
+        field = bytes([len(name)]) + name
+    # ffmpeg reads a MOV's name as a C string unless its 1st byte is its length
+    elif size > len(name) and not (mov and name[0] == size - 1):
+        field = name + bytes(size - len(name))
+    else:
+        raise ValueError("hdlr name can't be replaced in place")
+    data[payload + 24 : end] = field
+
+
+def strip_moov(data, start, end, found):
+    """Strips metadata from the boxes of bytearray data, an MP4 moov
+    box, between start and end, keeping every box's size: blanks
+    metadata and padding boxes, chapter tracks and references to them,
+    zeros creation and modification times, sets track languages to
+    found's "language" (undetermined), renames handlers as ffmpeg names
+    them (in a MOV if found's "mov"), and enables only the 1st track of each
+    handler type, as ffmpeg does with no metadata, chapters, or
+    dispositions. Appends to found's "handlers" the handler types of
+    tracks kept, and to its "samples" the file offset and size of the
+    samples of chapter tracks (IDs in its "chapters") for zeroing.
+    Raises ValueError if data isn't an MP4 box it understands."""
+    for kind, box_start, payload, box_end in containers.box_spans(data, start, end):
+        if kind in metadata_boxes or kind == b"chap":
+            data[box_start:box_end] = free_box(box_end - box_start, payload - box_start)
+        elif kind in (b"mvhd", b"tkhd", b"mdhd"):
+            # version 1 boxes have 64 bit times
+            if data[payload] == 1:
+                data[payload + 4 : payload + 20] = bytes(16)
+            else:
+                data[payload + 4 : payload + 12] = bytes(8)
+            if kind == b"mdhd":
+                language = payload + (32 if data[payload] == 1 else 20)
+                struct.pack_into(">H", data, language, found["language"])
+        elif kind == b"hdlr":
+            strip_handler_name(data, payload, box_end, found["mov"])
+        elif kind == b"tref":
+            strip_moov(data, payload, box_end, found)
+        elif kind in mp4_containers:
+            if kind == b"trak":
+                mdia = containers.child(data, payload, box_end, b"mdia")
+                hdlr = mdia and containers.child(data, *mdia, b"hdlr")
+                tkhd = containers.child(data, payload, box_end, b"tkhd")
+                if hdlr is None or tkhd is None:
+                    raise ValueError("trak without hdlr or tkhd")
+                track_id = tkhd[0] + (20 if data[tkhd[0]] == 1 else 12)
+                if struct.unpack_from(">I", data, track_id)[0] in found["chapters"]:
+                    stbl = containers.child(data, *mdia, b"minf")
+                    stbl = stbl and containers.child(data, *stbl, b"stbl")
+                    if stbl is None:
+                        raise ValueError("trak without stbl")
+                    found["samples"] += sample_ranges(data, *stbl)
+                    data[box_start:box_end] = free_box(
+                        box_end - box_start, payload - box_start
+                    )
+                    continue
+                handler = bytes(data[hdlr[0] + 8 : hdlr[0] + 12])
+                # the enabled flag is the lowest bit of tkhd's flags
+                if handler in found["handlers"]:
+                    data[tkhd[0] + 3] &= 0xFE
+                else:
+                    data[tkhd[0] + 3] |= 0x01
+                found["handlers"].append(handler)
+                if handler == b"vide":
+                    strip_compressor_names(data, mdia)
+            strip_moov(data, payload, box_end, found)
+
+
+def mp4_patches(filename, mov=False):
+    """Returns list of tuples of offset and bytes to write at that
+    offset of a copy of MP4 filename, or MOV if mov, to strip its
+    metadata, or None if filename isn't an MP4 that can be stripped this
+    way."""
+    patches = []
+    moov = None
+    try:
+        with open(filename, "rb") as f:
+            size = f.seek(0, 2)
+            pos = 0
+            while pos < size:
+                f.seek(pos)
+                header = f.read(16)
+                box_size, kind = struct.unpack_from(">I4s", header)
+                header_size = 8
+                if box_size == 1:
+                    box_size = struct.unpack_from(">Q", header, 8)[0]
+                    header_size = 16
+                elif box_size == 0:
+                    box_size = size - pos
+                if box_size < header_size or pos + box_size > size:
+                    return None
+                # fragmented mp4s have metadata in every fragment
+                if kind in (b"moof", b"mfra"):
+                    return None
+                if kind == b"moov":
+                    if moov is not None or box_size > containers.max_header:
+                        return None
+                    f.seek(pos)
+                    moov = (pos, bytearray(f.read(box_size)))
+                elif kind not in toplevel_boxes:
+                    if box_size > containers.max_header:
+                        return None
+                    patches.append((pos, free_box(box_size, header_size)))
+                pos += box_size
+        if moov is None:
+            return None
+        pos, data = moov
+        _, _, payload, _ = next(containers.box_spans(data))
+        found = {
+            "handlers": [],
+            "chapters": chapter_tracks(data, payload, len(data)),
+            "samples": [],
+            # undetermined, as ISO 639-2 code or QuickTime's unspecified
+            "language": 0x7FFF if mov else 0x55C4,
+            "mov": mov,
+        }
+        strip_moov(data, payload, len(data), found)
+    except (OSError, ValueError, IndexError, StopIteration, struct.error):
+        return None
+    # ffmpeg would only keep video and audio tracks
+    if not found["handlers"] or set(found["handlers"]) - {b"vide", b"soun"}:
+        return None
+    if any(offset + n > size for offset, n in found["samples"]):
+        return None
+    patches += [(offset, bytes(n)) for offset, n in found["samples"]]
+    patches.append((pos, bytes(data)))
+    return patches
+
+
+def strip_mp4_in_place(input_vid, output_vid):
+    """Strips metadata from MP4/MOV input_vid, as strip_metadata()
+    does, into output_vid without remuxing it: clones input_vid, only
+    copying blocks if need be, then overwrites the boxes holding
+    metadata with free boxes of the same size (so no sample offsets
+    change). Returns tuple of output_vid and the SHA-256 hex digests of
+    input_vid and output_vid, or None (leaving no output_vid) if
+    input_vid isn't an MP4 it can strip this way."""
+    patches = mp4_patches(input_vid, Path(input_vid).suffix.casefold() == ".mov")
+    if patches is None:
+        return None
+    try:
+        clone_file(input_vid, output_vid)
+        with open(output_vid, "r+b") as f:
+            for offset, patch in patches:
+                f.seek(offset)
+                f.write(patch)
+        # output_vid shares input_vid's blocks, so only read them once
+        digests = sha256_patched(input_vid, patches)
+    except OSError:
+        if os.path.isfile(output_vid):
+            os.remove(output_vid)
+        return None
+    return (output_vid, *digests)
 
 
 def strip_metadata(input_vid, output_vid):
     """Strips metadata from input_vid and places stripped video in
-    output_vid. If successful returns output_vid's path, otherwise
-    returns 'FAILED'."""
+    output_vid, in place for MP4s where possible otherwise with ffmpeg.
+    If successful returns tuple of output_vid's path and the SHA-256 hex
+    digests of input_vid and output_vid, otherwise raises RuntimeError
+    with ffmpeg's (or the OSError's) error message."""
+    if Path(input_vid).suffix.casefold() in (".mp4", ".mov"):
+        stripped = strip_mp4_in_place(input_vid, output_vid)
+        if stripped is not None:
+            return stripped
     command = [
         "ffmpeg",
         # set input video
@@ -181,50 +568,458 @@ def strip_metadata(input_vid, output_vid):
         output_vid,
     ]
 
+    # hashed as ffmpeg reads it, so it is read from disk just the once
+    stop_hashing = threading.Event()
+    hasher = ThreadPoolExecutor(max_workers=1)
+    input_digest = hasher.submit(sha256_file, input_vid, stop_hashing)
     try:
         subprocess.run(
             command,
+            # several ffmpegs run at once, none should read the terminal
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             check=True,
             text=True,
         )
     except subprocess.CalledProcessError as perr:
-        print(f"ffmpeg failed to strip '{input_vid}' with output:")
-        print(perr.stdout, "And error messages:", perr.stderr, sep="\n")
-        print("Script will continue to process the other videos.")
+        # the checksum isn't wanted, so don't wait to read the rest
+        stop_hashing.set()
         # File failed to process so delete it is ffmpeg made an
         # incomplete one
-        if output_vid.is_file():
-            output_vid.unlink()
-        return "FAILED"
+        if os.path.isfile(output_vid):
+            os.remove(output_vid)
+        # the last line says why, earlier ones are its progress
+        lines = perr.stderr.strip().splitlines() or [f"exit status {perr.returncode}"]
+        raise RuntimeError(lines[-1]) from perr
+    except BaseException:
+        stop_hashing.set()
+        raise
+    finally:
+        hasher.shutdown()
+
+    try:
+        # output_vid has only just been written, so is still in memory
+        return (output_vid, input_digest.result(), sha256_file(output_vid))
+    except OSError as err:
+        raise RuntimeError(err) from err
+
+
+def sha256_file(path, stop=None):
+    """Returns SHA-256 hex digest of path, read through mmap, or None if
+    stop (a threading.Event) is set before it is all read."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        # mmap can't map an empty file
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for start in range(0, size, hash_bytes):
+                        if stop is not None and stop.is_set():
+                            return None
+                        digest.update(view[start : start + hash_bytes])
+    return digest.hexdigest()
+
+
+def sha256_patched(path, patches):
+    """Returns tuple of SHA-256 hex digests of path and of path with
+    patches (tuples of offset and bytes, as from mp4_patches()) written
+    over it in order, reading path once."""
+    in_digest, out_digest = hashlib.sha256(), hashlib.sha256()
+    # patches by where they start, numbered so they are applied in order
+    spans = sorted((offset, i, patch) for i, (offset, patch) in enumerate(patches))
+    pos = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(hash_bytes), b""):
+            in_digest.update(block)
+            end = pos + len(block)
+            overlapping = []
+            for offset, i, patch in spans:
+                if offset >= end:
+                    break
+                if offset + len(patch) > pos:
+                    overlapping.append((i, offset, patch))
+            if overlapping:
+                block = bytearray(block)
+                for _, offset, patch in sorted(overlapping):
+                    start, stop = max(offset, pos), min(offset + len(patch), end)
+                    block[start - pos : stop - pos] = patch[
+                        start - offset : stop - offset
+                    ]
+            out_digest.update(block)
+            # drop patches that are all before the next block
+            while spans and spans[0][0] + len(spans[0][2]) <= end:
+                spans.pop(0)
+            pos = end
+    return (in_digest.hexdigest(), out_digest.hexdigest())
+
+
+def verify(csv_path, workers=4):
+    """Re-hashes the videos in csv_path, a csv log written by main(),
+    workers at a time. Returns tuple of how many videos were checked
+    and list of tuples of each that failed and why."""
+    expected = {}
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            if row.get("randomized_sha256"):
+                expected[row["original"]] = row["original_sha256"]
+                expected[row["randomized"]] = row["randomized_sha256"]
+    problems = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(sha256_file, path): path for path in expected}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                if future.result() != expected[path]:
+                    problems.append((path, "checksum differs"))
+            except OSError as err:
+                problems.append((path, err.strerror))
+    return (len(expected), problems)
+
+
+def quick_checksum(path):
+    """Returns hex digest of path's size and first, middle, and last
+    checksum_bytes, enough to tell a finished video from a partial one,
+    or most videos apart, without reading all of it."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        size = f.seek(0, 2)
+        digest.update(str(size).encode())
+        for offset in (0, (size - checksum_bytes) // 2, size - checksum_bytes):
+            f.seek(max(offset, 0))
+            digest.update(f.read(checksum_bytes))
+    return digest.hexdigest()
+
+
+def checksum(path):
+    """Returns hex digest of all of path."""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(checksum_bytes), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def same_key(groups, key, executor):
+    """Returns list of lists of 2+ paths in the same group of groups
+    (lists of paths) with the same key(path), run on executor."""
+    paths = [(i, path) for i, group in enumerate(groups) for path in group]
+    matches = {}
+    for (i, path), value in zip(paths, executor.map(key, (p for _, p in paths))):
+        matches.setdefault((i, value), []).append(path)
+    return [group for group in matches.values() if len(group) > 1]
+
+
+def find_duplicates(paths, workers=4):
+    """Returns dict of each path in paths that is the same as another to
+    the first (by name) it is the same as. Only paths of the same size
+    are hashed, and only those with the same quick_checksum() are hashed
+    in full, workers at a time."""
+    by_size = {}
+    for path in paths:
+        by_size.setdefault(os.path.getsize(path), []).append(path)
+    groups = [group for group in by_size.values() if len(group) > 1]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        groups = same_key(groups, quick_checksum, executor)
+        groups = same_key(groups, checksum, executor)
+    duplicates = {}
+    for group in groups:
+        group.sort(key=str)
+        duplicates.update((path, group[0]) for path in group[1:])
+    return duplicates
+
+
+def journal(journal_file, entries):
+    """Appends entries, an iterable of dicts, to open journal_file as
+    json lines, and makes sure they are on disk before returning."""
+    for entry in entries:
+        journal_file.write(json.dumps(entry) + "\n")
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+
+def read_journal(journal_path):
+    """Returns tuple of dict of original to de-identified paths, dict of
+    original paths to the done entries (see done_entry()) of finished
+    videos, dict of duplicate original paths to tuple of the original they
+    are the same as and how to copy it, and whether every video's plan
+    was journaled, from journal_path. A last line cut short (by a crash
+    while writing it) is ignored."""
+    vid_map, done, duplicates = {}, {}, {}
+    planned_all = False
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["event"] == "planned_all":
+                planned_all = entry["videos"] == len(vid_map)
+                continue
+            orig_path = entry["original"]
+            if entry["event"] == "planned":
+                vid_map[orig_path] = entry["output"]
+                if "duplicate_of" in entry:
+                    duplicates[orig_path] = (
+                        entry["duplicate_of"],
+                        entry["duplicate_mode"],
+                    )
+            elif entry["event"] == "done":
+                done[orig_path] = entry
+    return (vid_map, done, duplicates, planned_all)
 
-    return output_vid
+
+def planned_entries(vid_map, duplicates):
+    """Yields journal entries planning vid_map's videos, noting which of
+    duplicates each is the same as."""
+    for orig_path, new_path in vid_map.items():
+        entry = {"event": "planned", "original": orig_path, "output": new_path}
+        if orig_path in duplicates:
+            entry["duplicate_of"] = duplicates[orig_path][0]
+            entry["duplicate_mode"] = duplicates[orig_path][1]
+        yield entry
+
+
+def copy_duplicate(orig_path, new_path, mode):
+    """Makes new_path a copy of de-identified video orig_path, per mode
+    (see duplicate_modes), returning the path of the copy."""
+    if mode == "alias":
+        return orig_path
+    if mode == "hardlink":
+        os.link(orig_path, new_path)
+    else:
+        clone_file(orig_path, new_path)
+    return new_path
+
+
+def done_entry(orig_path, new_path, digests):
+    """Returns journal entry of orig_path being finished as new_path,
+    with digests, tuple of their SHA-256 hex digests."""
+    return {
+        "event": "done",
+        "original": orig_path,
+        "output": new_path,
+        "size": os.path.getsize(new_path),
+        "checksum": quick_checksum(new_path),
+        "original_sha256": digests[0],
+        "randomized_sha256": digests[1],
+    }
+
+
+def finished(new_path, entry):
+    """Checks if new_path is the finished video of done entry (see
+    done_entry())."""
+    try:
+        size = os.path.getsize(new_path)
+        return (size, quick_checksum(new_path)) == (entry["size"], entry["checksum"])
+    except OSError:
+        return False
 
 
 def main():
     """Will strip metadata and optionally randomize filenames from a
     directory of videos."""
     args = docopt(__doc__)
+    if args["--lookup"]:
+        missing = 0
+        for name in args["NAME"]:
+            path = lookup(args["OUTDIR"], name)
+            if path is None:
+                missing += 1
+                print(f"{name}: not found", file=sys.stderr)
+            else:
+                print(path)
+        sys.exit(1 if missing else 0)
 
-    vid_paths = get_video_paths(args["INDIR"])
-    outdir = Path(args["OUTDIR"])
     try:
-        outdir.mkdir()
-    except FileExistsError:
-        print(f"OUTDIR {outdir} must not already exist. Aborting.")
+        jobs = int(args["-j"])
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        print("JOBS must be a whole number of at least 1. Aborting.")
         sys.exit(2)
-    setup_log(args["-l"])
 
-    if args["-m"]:
-        vid_map = transpose_paths(vid_paths, outdir)
+    if args["--verify"]:
+        checked, problems = verify(args["CSVFILE"], jobs)
+        for path, why in problems:
+            print(f"{path}: {why}")
+        print(f"Verified {checked - len(problems)} of {checked} videos.")
+        sys.exit(1 if problems else 0)
+
+    if args["-d"] is not None and args["-d"] not in duplicate_modes:
+        print(f"MODE must be one of {', '.join(duplicate_modes)}. Aborting.")
+        sys.exit(2)
+
+    try:
+        levels = int(args["-L"])
+        width = fanouts[int(args["-f"])]
+    except (KeyError, ValueError):
+        levels = -1
+    if not 0 <= levels <= max_levels:
+        print(
+            f"LEVELS must be from 0 to {max_levels} and N one of "
+            f"{', '.join(map(str, fanouts))}. Aborting."
+        )
+        sys.exit(2)
+
+    outdir = args["OUTDIR"]
+    log_filename = log_name(args["-l"])
+    journal_path = log_filename + journal_suffix
+    if args["--resume"]:
+        if not os.path.isfile(journal_path):
+            print(f"No run to resume that wrote LOGFILE {log_filename}. Aborting.")
+            sys.exit(2)
+        vid_map, done, duplicates, planned_all = read_journal(journal_path)
+        if not planned_all:
+            # only some were named, and none stripped, before it stopped;
+            # the rest can't be named the same way without the run's options
+            print(
+                f"The run into OUTDIR {outdir} stopped before naming every "
+                "video, so none were stripped. Delete OUTDIR and start the "
+                "run again. Aborting."
+            )
+            sys.exit(2)
+        new_vids = set(get_video_paths(args["INDIR"])) - set(vid_map)
+        if new_vids:
+            print(
+                f"Ignoring {len(new_vids)} videos added to INDIR since the run began."
+            )
     else:
-        vid_map = randomize_paths(vid_paths, outdir, args["-s"])
+        vid_paths = get_video_paths(args["INDIR"])
+        try:
+            os.mkdir(outdir)
+        except FileExistsError:
+            print(f"OUTDIR {outdir} must not already exist. Aborting.")
+            sys.exit(2)
+        done = {}
+        duplicates = {}
+        if args["-d"] is not None:
+            duplicates = {
+                dup: (orig, args["-d"])
+                for dup, orig in find_duplicates(vid_paths, jobs).items()
+            }
+        # names are assigned as the paths are shuffled, into a dict that
+        # keeps the shuffled order for the journal and csv
+        if args["-m"]:
+            vid_map = dict(transpose_paths(vid_paths, outdir, levels, width))
+        else:
+            vid_map = dict(
+                randomize_paths(vid_paths, outdir, args["-s"], levels, width)
+            )
+        write_layout(outdir, levels, width)
+        del vid_paths
+        if args["-d"] == "alias":
+            for dup, (orig, _) in duplicates.items():
+                vid_map[dup] = vid_map[orig]
 
-    for orig_path, new_path in vid_map.items():
-        # strip metadata then save into the csv log file:
-        # orig_path,output (either new_path or "FAILED" if it was not successful)
-        logging.info("%s,%s", orig_path, strip_metadata(orig_path, new_path))
+    failures = []
+    # a new run replaces any old journal, as it does the csv
+    journal_mode = "a" if args["--resume"] else "w"
+    with open(journal_path, journal_mode) as journal_file, setup_log(
+        log_filename
+    ) as log_file:
+        log = csv.writer(log_file)
+        if not args["--resume"]:
+            # the names are random, so must be saved before any are used
+            journal(journal_file, planned_entries(vid_map, duplicates))
+            # only once the plans are on disk, so a crash can't leave this
+            # without some of them
+            journal(journal_file, [{"event": "planned_all", "videos": len(vid_map)}])
+        todo = []
+        dup_todo = []
+        # original paths to the SHA-256s of them and their stripped videos
+        digests = {}
+        # subdirectories of OUTDIR made so far
+        made_dirs = {outdir}
+        for orig_path, new_path in vid_map.items():
+            if orig_path in done and finished(new_path, done[orig_path]):
+                # journaled before checksums were, if they are missing
+                digests[orig_path] = (
+                    done[orig_path].get("original_sha256", ""),
+                    done[orig_path].get("randomized_sha256", ""),
+                )
+                log.writerow([orig_path, new_path, *digests[orig_path]])
+                continue
+            if orig_path in duplicates:
+                dup_todo.append(orig_path)
+                # an alias's new_path is the video it is the same as
+                if duplicates[orig_path][1] == "alias":
+                    continue
+            # left partly made by the interrupted run
+            if os.path.isfile(new_path):
+                os.remove(new_path)
+            new_dir = os.path.dirname(new_path)
+            if new_dir not in made_dirs:
+                os.makedirs(new_dir, exist_ok=True)
+                made_dirs.add(new_dir)
+            if orig_path in duplicates:
+                continue
+            if not os.path.isfile(orig_path):
+                failures.append((orig_path, "no longer exists"))
+                log.writerow([orig_path, "FAILED", "", ""])
+                continue
+            todo.append(orig_path)
+        if args["--resume"]:
+            print(
+                f"Resuming with {len(todo) + len(dup_todo)} of {len(vid_map)} "
+                "videos left."
+            )
+        # largest first so a big video isn't left running alone at the end
+        todo.sort(key=os.path.getsize, reverse=True)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    strip_metadata, orig_path, vid_map[orig_path]
+                ): orig_path
+                for orig_path in todo
+            }
+            for future in as_completed(futures):
+                orig_path = futures[future]
+                try:
+                    output, in_digest, out_digest = future.result()
+                    digests[orig_path] = (in_digest, out_digest)
+                    journal(
+                        journal_file,
+                        [done_entry(orig_path, output, digests[orig_path])],
+                    )
+                except RuntimeError as err:
+                    output = "FAILED"
+                    digests[orig_path] = ("", "")
+                    failures.append((orig_path, err))
+                    journal(journal_file, [{"event": "failed", "original": orig_path}])
+                # save into the csv log file, only from here so rows don't mix:
+                # orig_path,output (either new_path or "FAILED" if it was not
+                # successful) and their checksums
+                log.writerow([orig_path, output, *digests[orig_path]])
+
+        # copy the duplicates from the stripped videos they are the same as
+        failed = {orig_path for orig_path, _ in failures}
+        for dup_path in dup_todo:
+            orig_path, mode = duplicates[dup_path]
+            try:
+                if orig_path in failed:
+                    raise RuntimeError(f"same as {orig_path}, which failed")
+                output = copy_duplicate(vid_map[orig_path], vid_map[dup_path], mode)
+                # the same bytes as orig_path, so the same checksums
+                digests[dup_path] = digests[orig_path]
+                journal(journal_file, [done_entry(dup_path, output, digests[dup_path])])
+            except (OSError, RuntimeError) as err:
+                output = "FAILED"
+                digests[dup_path] = ("", "")
+                failures.append((dup_path, err))
+            log.writerow([dup_path, output, *digests[dup_path]])
+
+    if failures:
+        print(f"Failed to strip {len(failures)} of {len(vid_map)} videos:")
+        for orig_path, err in failures:
+            print(f"{orig_path}: {err}")
+        print("Retry them with --resume.")
+        sys.exit(1)
+    # the journal names the original videos, so only keep it if needed
+    os.remove(journal_path)
 
 
 if __name__ == "__main__":
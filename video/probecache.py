@@ -0,0 +1,117 @@
+# probecache.py,v1.0.0
+
+# Copyright (c) 2021 Thomas Ward <thomas@thomasward.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Persistent cache of ffprobe output, shared by vidinfo.py and
+video_processor.py, in a SQLite database. Entries are keyed on a video's
+path and the ffprobe query, and only used while the video's inode, size,
+and modification time are unchanged.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+default_path = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "tmw-misc",
+    "probes.sqlite",
+)
+
+
+def open_cache(path=default_path):
+    """
+    Returns a cache, a dict holding the database's connection and hit
+    counts, using the database at path (made if need be). It can be
+    shared between threads, and reconnects in forked processes.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    cache = {"path": path, "lock": threading.Lock(), "hits": 0, "misses": 0}
+    connection(cache)
+    return cache
+
+
+def connection(cache):
+    """Returns the cache's database connection for this process."""
+    if cache.get("conn") is None or cache.get("pid") != os.getpid():
+        # several runs can use the cache at once, wait for their writes
+        conn = sqlite3.connect(cache["path"], timeout=60, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "path TEXT, query TEXT, inode INTEGER, size INTEGER, "
+            "mtime_ns INTEGER, output TEXT, probed REAL, "
+            "PRIMARY KEY (path, query))"
+        )
+        cache["conn"], cache["pid"] = conn, os.getpid()
+    return cache["conn"]
+
+
+def cached_probe(cache, filename, query, probe):
+    """
+    Returns filename's output for query from cache if filename has not
+    changed since it was cached, else calls probe(filename) and caches
+    its output (which must be json serializable).
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with cache["lock"]:
+        row = (
+            connection(cache)
+            .execute(
+                "SELECT inode, size, mtime_ns, output FROM probes "
+                "WHERE path = ? AND query = ?",
+                (path, query),
+            )
+            .fetchone()
+        )
+        if row is not None and tuple(row[:3]) == identity:
+            cache["hits"] += 1
+            return json.loads(row[3])
+        cache["misses"] += 1
+    output = probe(filename)
+    with cache["lock"]:
+        conn = connection(cache)
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, query, *identity, json.dumps(output), time.time()),
+            )
+    return output
+
+
+def prune(cache):
+    """Removes entries of files that no longer exist. Returns how many."""
+    with cache["lock"]:
+        conn = connection(cache)
+        paths = [row[0] for row in conn.execute("SELECT DISTINCT path FROM probes")]
+        gone = [(path,) for path in paths if not os.path.exists(path)]
+        with conn:
+            conn.executemany("DELETE FROM probes WHERE path = ?", gone)
+        return len(gone)
+
+
+def report(cache):
+    """Returns string reporting the cache's hits and misses this run."""
+    total = cache["hits"] + cache["misses"]
+    rate = cache["hits"] / total * 100 if total else 0
+    return (
+        f"Probe cache: {cache['hits']} hits, {cache['misses']} misses "
+        f"({rate:.1f}% hit rate)."
+    )
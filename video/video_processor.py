@@ -24,21 +24,59 @@ container. Requires ffprobe and ffmpeg installed.
 """
 
 import argparse
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+import csv
 from datetime import datetime
 from functools import partial
+from hashlib import sha256
 import json
 import os
-from shutil import rmtree, which
+from shutil import copyfile, move, rmtree, which
+import sqlite3
 import subprocess
 import sys
 from tempfile import mkdtemp
+import threading
+import time
 from uuid import uuid4
 
+import probecache
 import pyask
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 vid_exts = (".avi", ".flv", ".m4v", ".mkv", ".mpg", ".mov", ".mp4", ".webm", ".wmv")
 stderr = partial(print, file=sys.stderr)
+# lines of stderr kept for error messages
+stderr_tail = 50
+# off in batch mode, where jobs would draw over each other's progress
+show_progress_bar = True
+# resource use of each run() since process_directory() started
+telemetry = []
+# ffprobe options (bar the filename) used to get video information
+ffprobe_args = [
+    "ffprobe",
+    "-hide_banner",
+    "-select_streams",
+    "v",
+    "-show_entries",
+    "format=filename,format_name,duration,bit_rate:format_tags=:"
+    "stream=codec_name,width,height,pix_fmt,time_base:"
+    "stream_disposition=:"
+    "stream_tags=",
+    "-print_format",
+    "json",
+]
+# ffprobe output cache of original videos, see probecache.py
+probe_cache = None
+# ioctl(2) to share a file's blocks with another (a reflink), see ioctl_ficlone(2)
+FICLONE = 0x40049409
 
 
 def stderr_and_exit(*args, **kwargs):
@@ -93,22 +131,146 @@ def parser():
         help="Do not offer to trim the video.",
         action="store_true",
     )
-    prsr.add_argument("directory", help="directory with videos")
+    prsr.add_argument(
+        "-x",
+        "--exact-trim",
+        default=False,
+        help="Trim on the exact times given rather than the nearest "
+        "i-frames (re-encodes the start and end of the trimmed video).",
+        action="store_true",
+    )
+    prsr.add_argument(
+        "-s",
+        "--snap",
+        default=False,
+        help="Move trim times to the nearest keyframes, where stream copies "
+        "can cut exactly, without asking.",
+        action="store_true",
+    )
+    prsr.add_argument(
+        "-e",
+        "--encode-workers",
+        default=min(4, os.cpu_count() or 1),
+        type=int,
+        help="If transcoding is needed, split the video into this many "
+        "segments and encode them at once.",
+    )
+    prsr.add_argument(
+        "-w",
+        "--workdir",
+        action="append",
+        help="Directory in which to keep intermediate videos, e.g. a "
+        "scratch volume or tmpfs. Repeat to give fallbacks for when there "
+        "is not enough space. If none given, uses the video directory.",
+    )
+    prsr.add_argument(
+        "-c",
+        "--cache",
+        metavar="DIR",
+        help="Cache the output of every ffmpeg pass in DIR so re-runs, "
+        "including ones that only change later options, reuse finished work.",
+    )
+    prsr.add_argument(
+        "--cache-size",
+        default=50,
+        type=float,
+        metavar="GB",
+        help="Evict the least recently used videos from the cache once it "
+        "is bigger than this.",
+    )
+    prsr.add_argument(
+        "--cache-list",
+        default=False,
+        help="List what is in the cache and exit.",
+        action="store_true",
+    )
+    prsr.add_argument(
+        "--cache-clear",
+        default=False,
+        help="Empty the cache and exit.",
+        action="store_true",
+    )
+    prsr.add_argument(
+        "--probe-cache",
+        default=probecache.default_path,
+        metavar="FILE",
+        help="ffprobe output cache (a SQLite database shared with vidinfo.py).",
+    )
+    prsr.add_argument(
+        "--no-probe-cache",
+        default=False,
+        help="Probe the videos rather than using the probe cache.",
+        action="store_true",
+    )
+    prsr.add_argument(
+        "-b",
+        "--batch",
+        metavar="MANIFEST",
+        help="Process, without asking any questions, every directory listed "
+        "in MANIFEST (a json or csv file) instead of a single directory.",
+    )
+    prsr.add_argument(
+        "-j",
+        "--jobs",
+        default=2,
+        type=int,
+        help="Number of directories to process at once in batch mode.",
+    )
+    prsr.add_argument("directory", nargs="?", help="directory with videos")
     return prsr
 
 
-def validate_args(args):
-    """Validates args and returns them if all valid."""
+def check_args(args):
+    """Checks args. Raises ValueError if any are invalid."""
     if not os.path.isdir(args.directory):
-        stderr_and_exit(f"{args.directory} is not a directory. Exiting.")
+        raise ValueError(f"{args.directory} is not a directory.")
     if args.output is not None:
-        if os.path.exists(args.output):
-            stderr_and_exit(f"{args.output} already exists. Exiting.")
+        if os.path.exists(os.path.join(args.directory, args.output)):
+            raise ValueError(f"{args.output} already exists.")
         out_ext = os.path.splitext(args.output)[1]
         if out_ext not in vid_exts:
-            stderr_and_exit("Output file must have a valid video extension. Exiting.")
+            raise ValueError("Output file must have a valid video extension.")
         if not args.keep_format and out_ext != ".mp4":
-            stderr_and_exit('Output file must have "mp4" extension. Exiting.')
+            raise ValueError('Output file must have "mp4" extension.')
+
+
+def validate_args(args):
+    """Validates args and returns them if all valid."""
+    if args.encode_workers < 1:
+        stderr_and_exit("Need at least one encode worker. Exiting.")
+    for workdir in args.workdir or []:
+        if not os.path.isdir(workdir):
+            stderr_and_exit(f"{workdir} is not a directory. Exiting.")
+    if args.workdir is not None:
+        # we later cd into "directory"
+        args.workdir = [os.path.abspath(workdir) for workdir in args.workdir]
+    args.probe_cache = os.path.abspath(args.probe_cache)
+    if args.cache is not None:
+        args.cache = os.path.abspath(args.cache)
+        try:
+            os.makedirs(args.cache, exist_ok=True)
+        except OSError as err:
+            stderr_and_exit(f"Could not make cache {args.cache}: {err} Exiting.")
+    elif args.cache_list or args.cache_clear:
+        stderr_and_exit("Need a cache (-c) to list or clear. Exiting.")
+    if args.cache_list or args.cache_clear:
+        return args
+    if args.batch is not None:
+        if args.directory is not None:
+            stderr_and_exit("Give either a directory or a batch manifest. Exiting.")
+        if args.output is not None:
+            stderr_and_exit("Give output filenames in the batch manifest. Exiting.")
+        if not os.path.isfile(args.batch):
+            stderr_and_exit(f"{args.batch} is not a file. Exiting.")
+        if args.jobs < 1:
+            stderr_and_exit("Need at least one job. Exiting.")
+        return args
+    if args.directory is None:
+        stderr_and_exit("Need a directory with videos. Exiting.")
+    try:
+        check_args(args)
+    except ValueError as err:
+        stderr_and_exit(f"{err} Exiting.")
     return args
 
 
@@ -117,42 +279,173 @@ def is_video(filename):
     return filename.casefold().endswith(vid_exts)
 
 
-def run(commands):
+def child_io(pid):
     """
-    Convenience wrapper around subprocess.run().
-    Runs commands, returning stdout. Exits on error if it fails.
+    Returns tuple of bytes read and written by exited, but unreaped,
+    process pid, or None if unknown (/proc is Linux only).
     """
     try:
-        return subprocess.run(
-            commands,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,
-            encoding="utf-8",
-        ).stdout
-    except subprocess.CalledProcessError as err:
-        raise RuntimeError(f'"{" ".join(commands)}" failed:\n{err.stderr}') from err
-
-
-def ffprobe(filename):
-    """Call ffprobe on filename. Returns dict of ffprobe's output."""
-    return json.loads(
-        run(
-            [
-                "ffprobe",
-                "-hide_banner",
-                "-select_streams",
-                "v",
-                "-show_entries",
-                "format=filename,format_name,duration:format_tags=:"
-                "stream=codec_name,width,height:stream_disposition=:"
-                "stream_tags=",
-                "-print_format",
-                "json",
-                filename,
-            ]
-        )
+        with open(f"/proc/{pid}/io") as io:
+            fields = dict(line.split(": ") for line in io.read().splitlines())
+        return (int(fields["rchar"]), int(fields["wchar"]))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def expected_duration(commands, stderr_lines):
+    """
+    Returns how many seconds of video ffmpeg commands should output:
+    the -t given, else the first input's duration from its stderr_lines,
+    else None.
+    """
+    if "-t" in commands:
+        return float(commands[len(commands) - commands[::-1].index("-t")])
+    for line in list(stderr_lines):
+        if "Duration: " in line:
+            hms = line.split("Duration: ", 1)[1].split(",", 1)[0]
+            try:
+                h, m, s = hms.split(":")
+                return int(h) * 3600 + int(m) * 60 + float(s)
+            except ValueError:
+                return None
+    return None
+
+
+def show_progress(stage, progress, duration):
+    """Shows, on one line of stderr, progress of an ffmpeg run."""
+    # out_time is negative, or N/A, until the first frame is written
+    out_time = max(0, int(progress.get("out_time_us", "0").strip("N/A") or 0) / 1e6)
+    speed = progress.get("speed", "").strip().rstrip("x")
+    line = (
+        f"\r{stage}: {progress.get('fps', '0')} fps, {speed or 'N/A'}x, "
+        f"{time.strftime('%H:%M:%S', time.gmtime(out_time))}"
+    )
+    if duration:
+        line += time.strftime(" / %H:%M:%S", time.gmtime(duration))
+        try:
+            eta = max(0, duration - out_time) / float(speed)
+            line += time.strftime(", ETA %H:%M:%S", time.gmtime(eta))
+        except (ValueError, ZeroDivisionError):
+            pass
+    sys.stderr.write(line.ljust(79))
+    sys.stderr.flush()
+
+
+def watch_progress(stdout, commands, stderr_lines, stage, show=True):
+    """
+    Reads ffmpeg's -progress key=value blocks from stdout as they come
+    and, if show and stderr is a terminal, shows them.
+    """
+    show = show and show_progress_bar and sys.stderr.isatty()
+    progress = {}
+    shown = False
+    for line in stdout:
+        key, _, value = line.strip().partition("=")
+        progress[key] = value
+        if key == "progress" and show:
+            show_progress(stage, progress, expected_duration(commands, stderr_lines))
+            shown = True
+    if shown:
+        sys.stderr.write("\n")
+
+
+def run(commands, stage=None, progress=True):
+    """
+    Convenience wrapper around subprocess.Popen().
+    Runs commands, returning stdout. Shows ffmpeg's progress if progress
+    and records the run's resource use in telemetry. Raises RuntimeError,
+    with the tail of stderr, if it fails.
+    """
+    stage = stage or commands[0]
+    ffmpeg = commands[0] == "ffmpeg"
+    if ffmpeg:
+        commands = commands[:1] + ["-nostats", "-progress", "pipe:1"] + commands[1:]
+    start_time = time.perf_counter()
+    # not the terminal's stdin, which several ffmpegs at once would fight
+    # over (reading keys such as q, to quit, and changing its settings)
+    proc = subprocess.Popen(
+        commands,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+    )
+    # only keep the tail of stderr, ffmpeg's can be huge on long videos
+    stderr_lines = deque(maxlen=stderr_tail)
+    reader = threading.Thread(target=stderr_lines.extend, args=(proc.stderr,))
+    reader.start()
+    if ffmpeg:
+        stdout = ""
+        watch_progress(proc.stdout, commands, stderr_lines, stage, progress)
+    else:
+        stdout = proc.stdout.read()
+    reader.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    io = None
+    # waitid() isn't on macOS
+    if hasattr(os, "waitid"):
+        # wait, but don't reap, so can still read its /proc/<pid>/io
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        io = child_io(proc.pid)
+    usage = None
+    # wait4() isn't on Windows
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.wait()
+    cpu_time = peak_rss = None
+    if usage is not None:
+        cpu_time = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in bytes on macOS, KB elsewhere
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        if io is None:
+            io = (usage.ru_inblock * 512, usage.ru_oublock * 512)
+    io = io or (None, None)
+    telemetry.append(
+        {
+            "stage": stage,
+            "returncode": proc.returncode,
+            "wall_time": time.perf_counter() - start_time,
+            "cpu_time": cpu_time,
+            "peak_rss_bytes": peak_rss,
+            "bytes_read": io[0],
+            "bytes_written": io[1],
+        }
     )
+    if proc.returncode != 0:
+        raise RuntimeError(f'"{" ".join(commands)}" failed:\n{"".join(stderr_lines)}')
+    return stdout
+
+
+def use_probe_cache(args):
+    """Opens, unless args say not to, the probe cache from args."""
+    global probe_cache
+    if args.no_probe_cache:
+        probe_cache = None
+    elif probe_cache is None or probe_cache["path"] != args.probe_cache:
+        try:
+            probe_cache = probecache.open_cache(args.probe_cache)
+        except (OSError, sqlite3.Error) as err:
+            stderr(f"Not using probe cache {args.probe_cache}: {err}")
+
+
+def ffprobe(filename, cached=False):
+    """
+    Call ffprobe on filename. Returns dict of ffprobe's output, from the
+    probe cache if cached and filename is unchanged since it was cached.
+    """
+    if cached and probe_cache is not None:
+        query = " ".join(ffprobe_args)
+        output = probecache.cached_probe(probe_cache, filename, query, ffprobe)
+        # may have been cached under another path to the same file
+        output["format"]["filename"] = filename
+        return output
+    return json.loads(run(ffprobe_args + [filename]))
 
 
 def make_workdir(directory="."):
@@ -160,53 +453,274 @@ def make_workdir(directory="."):
     try:
         workdir = mkdtemp(dir=directory)
     except OSError as err:
-        stderr_and_exit(
+        raise RuntimeError(
             f'Failed to make temporary working directory with error:\n"{err}"'
-        )
-    # return relative path as we later cd into "directory"
-    return os.path.relpath(workdir, directory)
+        ) from err
+    # return relative path (to "directory" that we cd'ed into) for tidier logs
+    return os.path.relpath(workdir)
 
 
-def make_ffmpeg_concat_file(videos, workdir):
-    """Writes file with list of videos for ffmpeg concat to work."""
+def free_space(directory):
+    """Returns bytes of free space available in directory's filesystem."""
+    stats = os.statvfs(directory)
+    return stats.f_bavail * stats.f_frsize
+
+
+def estimate_size(infos, trim_times):
+    """
+    Estimates the size, in bytes, of a video made from the videos with
+    ffprobe outputs infos, trimmed to trim_times.
+    """
+    size = sum(float(i["format"].get("bit_rate", 0)) / 8 * duration(i) for i in infos)
+    length = sum(map(duration, infos))
+    if length and is_trimmed(trim_times):
+        end = length if trim_times["end"] is None else min(trim_times["end"], length)
+        size *= max(0, end - trim_times["start"]) / length
+    return size
+
+
+def pick_workdir_parent(candidates, needed, final_dir="."):
+    """
+    Returns first of candidates, directories in which to make the
+    working directory, with needed bytes free. As the final video is
+    then moved into final_dir, it also needs room for a copy of it when
+    on another filesystem. Raises RuntimeError if none fit.
+    """
+    for candidate in candidates:
+        if free_space(candidate) < needed:
+            continue
+        if os.stat(candidate).st_dev != os.stat(final_dir).st_dev:
+            if free_space(final_dir) < needed / 2:
+                raise RuntimeError(
+                    f"Not enough space in {os.path.abspath(final_dir)} for the "
+                    f"final video (needs about {needed / 2 / 1e6:.0f} MB)."
+                )
+        return candidate
+    raise RuntimeError(
+        f"Not enough space in {', '.join(candidates)} to make the video "
+        f"(needs about {needed / 1e6:.0f} MB)."
+    )
+
+
+def make_ffmpeg_concat_file(videos, workdir, durations=None, trim_times=None):
+    """
+    Writes file with list of videos for ffmpeg concat to work. If given
+    trim_times (and the durations of videos), only lists the videos
+    within trim_times with in/outpoints so concat does the trim.
+    """
     concat_filesname = os.path.join(workdir, "files.txt")
+    video_end = 0
     with open(concat_filesname, "w") as concat_files:
-        for video in videos:
-            concat_files.write(f"file '{os.path.join('..', video)}'\n")
+        for video, length in zip(videos, durations or [None] * len(videos)):
+            inpoint = outpoint = None
+            if trim_times is not None and is_trimmed(trim_times):
+                start, end = trim_times["start"], trim_times["end"]
+                video_start, video_end = video_end, video_end + length
+                # skip videos entirely outside of trim times
+                if video_end <= start or (end is not None and video_start >= end):
+                    continue
+                if start > video_start:
+                    inpoint = start - video_start
+                if end is not None and end < video_end:
+                    outpoint = end - video_start
+            concat_files.write(f"file '{os.path.abspath(video)}'\n")
+            if inpoint is not None:
+                concat_files.write(f"inpoint {inpoint}\n")
+            if outpoint is not None:
+                concat_files.write(f"outpoint {outpoint}\n")
     return concat_filesname
 
 
-def concat(infiles, outfile, workdir):
+def input_args(videos, workdir, durations=None, trim_times=None):
     """
-    Takes a list of string filenames for videos, concats with ffmpeg,
-    and returns tuple of concated filename and number of videos
-    concatenated. This requires videos to have same codec.
+    Returns ffmpeg input options to read videos as a single video. When
+    given durations and trim_times, multiple videos are trimmed as they
+    are concatenated.
     """
+    if len(videos) == 1:
+        return ["-i", videos[0]]
+    return [
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        make_ffmpeg_concat_file(videos, workdir, durations, trim_times),
+    ]
+
+
+def map_args(keep_audio=True, keep_metadata=True):
+    """Returns ffmpeg options selecting which input streams to output."""
+    if not keep_metadata:
+        # only video and, if wanted and present, audio streams. Other
+        # streams (data, subtitles, etc) do not survive metadata stripping
+        return ["-map", "0:v"] + (["-map", "0:a?"] if keep_audio else [])
+    if keep_audio:
+        return ["-map", "0"]
+    # all streams except audio
+    return ["-map", "0", "-map", "-0:a"]
+
+
+# ffmpeg output options to strip metadata
+strip_metadata_args = [
+    # strip global metadata for the video container
+    "-map_metadata",
+    "-1",
+    # strip metadata for video stream
+    "-map_metadata:s:v",
+    "-1",
+    # strip metadata for audio stream
+    "-map_metadata:s:a",
+    "-1",
+    # remove any chapter information
+    "-map_chapters",
+    "-1",
+    # remove any disposition info
+    "-disposition",
+    "0",
+]
+
+# ffmpeg output options to transcode video to h264 at nearly lossless
+# conversion crf setting. Passes frames through as is (no duplicating or
+# dropping to make a constant frame rate), so encoding a video in
+# segments gives the same frames as encoding it all at once
+x264_args = [
+    "-c:v",
+    "libx264",
+    "-preset",
+    "slow",
+    "-crf",
+    "18",
+    "-vsync",
+    "passthrough",
+]
+
+
+def ask_video_order(infiles):
+    """Asks user which videos, in order, to concat. Returns list of them."""
     if len(infiles) == 1:
-        return (infiles[0], 1)
-    videos = pyask.which_items(
+        return infiles
+    return pyask.which_items(
         infiles,
         "Which videos, in order, should be stitched together?",
         allow_repeats=False,
         default=", ".join(map(str, range(0, len(infiles)))),
     )
-    run(
-        [
-            "ffmpeg",
-            "-f",
-            "concat",
-            "-safe",
-            "0",
-            "-i",
-            make_ffmpeg_concat_file(videos, workdir),
-            "-map",
-            "0",
-            "-c",
-            "copy",
-            outfile,
-        ]
+
+
+def concat(videos, outfile, workdir):
+    """
+    Takes a list of string filenames for videos, concats with ffmpeg,
+    and returns the concated filename. This requires videos to have
+    same codec.
+    """
+    if len(videos) == 1:
+        return videos[0]
+    run(["ffmpeg"] + input_args(videos, workdir) + ["-map", "0", "-c", "copy", outfile])
+    return outfile
+
+
+def probe_videos(videos, workers=8, cached=False):
+    """
+    Calls ffprobe on videos, workers at a time, using the probe cache if
+    cached. Returns list of outputs.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(partial(ffprobe, cached=cached), videos))
+
+
+def stream_format(info):
+    """
+    Returns tuple of what must match for videos to concat from ffprobe
+    output info: codec, width, height, time base, and pixel format.
+    """
+    stream = info["streams"][0] if info["streams"] else {}
+    return tuple(
+        stream.get(k) for k in ("codec_name", "width", "height", "time_base", "pix_fmt")
+    )
+
+
+# ffmpeg output options to encode video streams, by codec, at nearly
+# lossless quality
+codec_args = {
+    "h264": ["-c:v", "libx264", "-preset", "slow", "-crf", "18"],
+    "hevc": ["-c:v", "libx265", "-preset", "slow", "-crf", "18"],
+    "mpeg4": ["-c:v", "mpeg4", "-q:v", "2"],
+    "mjpeg": ["-c:v", "mjpeg", "-q:v", "2"],
+    "vp9": ["-c:v", "libvpx-vp9", "-crf", "18", "-b:v", "0"],
+}
+
+
+def normalize_args(fmt, extension):
+    """
+    Returns ffmpeg output options to encode a video into format fmt, as
+    from stream_format(), in a container with extension.
+    """
+    codec, width, height, time_base, pix_fmt = fmt
+    if codec not in codec_args:
+        raise RuntimeError(f"Do not know how to encode videos to {codec}.")
+    if extension in (".mp4", ".m4v", ".mov"):
+        # mp4/mov stream time bases are the track's timescale
+        tb_args = ["-video_track_timescale", time_base.split("/")[1]]
+    else:
+        tb_args = ["-enc_time_base", time_base]
+    return (
+        codec_args[codec]
+        + ["-vf", f"scale={width}:{height}", "-pix_fmt", pix_fmt]
+        + tb_args
+        + ["-vsync", "passthrough"]
     )
-    return (outfile, len(videos))
+
+
+def normalize(videos, infos, workdir, workers=1, cache=None, identities=None):
+    """
+    Checks if all videos (with ffprobe outputs infos) can be
+    concatenated and re-encodes, workers at a time, those that differ
+    to match the format of the majority. Returns tuple of the list of
+    videos to concat, their ffprobe outputs, and dict of re-encoded
+    videos to what they were re-encoded as. If given a cache, re-encodes
+    are cached there, keyed on the video's identity (from identities,
+    which gains the re-encodes' identities) and the encode options.
+    """
+    formats = [stream_format(info) for info in infos]
+    majority = Counter(formats).most_common(1)[0][0]
+    odd = [i for i, fmt in enumerate(formats) if fmt != majority]
+    if not odd:
+        return (videos, infos, {})
+    extension = os.path.splitext(videos[formats.index(majority)])[1].casefold()
+    out_args = normalize_args(majority, extension)
+    outfiles = [random_videoname(extension, workdir) for _ in odd]
+    keys = {}
+    if cache is not None:
+        for i, outfile in zip(odd, outfiles):
+            key = sha256(
+                json.dumps([identities[os.path.abspath(videos[i])], out_args]).encode()
+            ).hexdigest()
+            identities[os.path.abspath(outfile)] = keys[outfile] = key
+    todo = [
+        (i, outfile)
+        for i, outfile in zip(odd, outfiles)
+        if cache is None or not cache_restore(cache, keys[outfile], outfile)
+    ]
+
+    def encode(i, outfile):
+        run(
+            ["ffmpeg", "-i", videos[i], "-map", "0", "-c", "copy"]
+            + out_args
+            + [outfile],
+            stage="normalize",
+            progress=False,
+        )
+        if cache is not None:
+            cache_store(cache, keys[outfile], outfile, ["normalize"])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda job: encode(*job), todo))
+    normalized = {videos[i]: outfile for i, outfile in zip(odd, outfiles)}
+    videos, infos = videos.copy(), infos.copy()
+    for i, outfile, info in zip(odd, outfiles, probe_videos(outfiles)):
+        videos[i], infos[i] = outfile, info
+    return (videos, infos, normalized)
 
 
 def get_trim_times():
@@ -219,142 +733,874 @@ def get_trim_times():
         print("Start time must come before end time. Try again.")
 
 
-def trim(infile, outfile):
-    """Trim video with ffmpeg. Returns tuple of filename and dict of trim times"""
+def ask_trim_times():
+    """Asks user if and where to trim. Returns dict of trim times."""
     if not pyask.yes_no("Does the video need to be trimmed?", default="yes"):
-        return (infile, {"start": 0, "end": None})
+        return {"start": 0, "end": None}
     start, end = get_trim_times()
+    return {"start": start, "end": end}
+
+
+def is_trimmed(trim_times):
+    """Checks if trim_times actually trim anything."""
+    return trim_times["start"] != 0 or trim_times["end"] is not None
+
+
+def trim_args(trim_times, concat=False):
+    """
+    Returns tuple of ffmpeg input options and output options to trim
+    a video to trim_times. If concat is True, the concat demuxer does
+    the seeking via in/outpoints instead.
+    """
+    if not is_trimmed(trim_times):
+        return ([], [])
+    in_args = []
+    out_args = []
+    if not concat:
+        # need -ss before -i for fast seeking
+        in_args += ["-ss", str(trim_times["start"])]
+        if trim_times["end"] is not None:
+            out_args += ["-t", str(trim_times["end"] - trim_times["start"])]
+    # make all output streams have positive timestamps (could happen if
+    # audio split precise but had to split on later i-frame)
+    out_args += ["-avoid_negative_ts", "1"]
+    return (in_args, out_args)
+
+
+def trim(infile, outfile, trim_times):
+    """Trim video with ffmpeg to trim_times. Returns trimmed filename."""
+    if not is_trimmed(trim_times):
+        return infile
+    in_args, out_args = trim_args(trim_times)
+    # copy, so it's fast. not necessarily precise b/c splits on i-frames
     run(
-        [
-            "ffmpeg",
-            # need -ss before -i for fast seeking
-            "-ss",
-            str(start),
-            "-i",
-            infile,
-            "-t",
-            str(end - start),
-            # use all streams
-            "-map",
-            "0",
-            # copy, so it's fast. not necessarily precise b/c splits on i-frames
-            "-c",
-            "copy",
-            # make all output streams have positive timestamps (could
-            # happen if audio split precise but had to split on later
-            # i-frame)
-            "-avoid_negative_ts",
-            "1",
-            outfile,
-        ]
+        ["ffmpeg"]
+        + in_args
+        + ["-i", infile, "-map", "0", "-c", "copy"]
+        + out_args
+        + [outfile]
     )
-    return (outfile, {"start": start, "end": end})
+    return outfile
 
 
 def remove_audio(infile, outfile):
     """Remove audio from video with ffmpeg."""
-    run(
+    # copy, don't need to transcode
+    run(["ffmpeg", "-i", infile] + map_args(keep_audio=False) + ["-c", "copy", outfile])
+    return outfile
+
+
+def keyframe_times(filename):
+    """
+    Returns sorted list of times, in seconds from the start of the
+    video (as ffmpeg's -ss counts them), of the video's keyframes.
+    """
+    packets = run(
         [
-            "ffmpeg",
-            "-i",
-            infile,
-            # keep all streams
-            "-map",
-            "0",
-            # except audio
-            "-map",
-            "-0:a",
-            # copy, don't need to transcode
-            "-c",
-            "copy",
-            outfile,
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            # packet flags are read without decoding the video
+            "-show_entries",
+            "packet=pts_time,flags:format=start_time",
+            "-print_format",
+            "csv=print_section=0",
+            filename,
+        ]
+    )
+    start_time = 0
+    times = []
+    for packet in packets.splitlines():
+        fields = packet.split(",")
+        # the format's start time is the only line with one field
+        if len(fields) == 1:
+            start_time = float(fields[0]) if fields[0] != "N/A" else 0
+        elif "K" in fields[1] and fields[0] != "N/A":
+            times.append(float(fields[0]))
+    return sorted(t - start_time for t in times)
+
+
+def keyframe_index_name(filename):
+    """Returns filename of the sidecar file caching filename's keyframes."""
+    directory, basename = os.path.split(filename)
+    return os.path.join(directory, f".{basename}.keyframes.json")
+
+
+def cached_keyframe_times(filename):
+    """
+    Returns keyframe_times(filename), read from its sidecar file if that
+    was made from this version (same size and mtime) of filename, else
+    scanned from filename and saved to the sidecar file.
+    """
+    stat = os.stat(filename)
+    key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    index_name = keyframe_index_name(filename)
+    try:
+        with open(index_name) as index_file:
+            index = json.load(index_file)
+        if index["key"] == key:
+            return index["keyframes"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    times = keyframe_times(filename)
+    # write then rename so a concurrent run never reads half an index
+    tmp_name = f"{index_name}.{uuid4().hex}"
+    try:
+        with open(tmp_name, "w") as index_file:
+            json.dump({"key": key, "keyframes": times}, index_file)
+        os.replace(tmp_name, index_name)
+    except OSError:
+        # e.g. read-only directory, so just go without the cache
+        remove_files([tmp_name])
+    return times
+
+
+def sequence_keyframes(videos, durations, workers=8):
+    """
+    Returns sorted list of keyframe times of videos, with durations, as
+    if they had been concatenated into one video.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        video_times = list(executor.map(cached_keyframe_times, videos))
+    times = []
+    offset = 0
+    for video_time, video_duration in zip(video_times, durations):
+        times += [offset + t for t in video_time]
+        offset += video_duration
+    return times
+
+
+def nearest_keyframe(keyframes, seconds):
+    """Returns the time in sorted keyframes nearest to seconds."""
+    i = bisect_left(keyframes, seconds)
+    return min(keyframes[max(0, i - 1) : i + 1], key=lambda t: abs(t - seconds))
+
+
+def trim_drift(videos, durations, trim_times):
+    """
+    Returns dict, for each of the trim_times that trims videos (with
+    durations), of the time, the nearest keyframe, and how far apart
+    they are in seconds.
+    """
+    keyframes = sequence_keyframes(videos, durations)
+    drift = {}
+    if not keyframes:
+        return drift
+    for point in ("start", "end"):
+        if trim_times[point] in (0, None):
+            continue
+        keyframe = nearest_keyframe(keyframes, trim_times[point])
+        drift[point] = {
+            "requested": trim_times[point],
+            "keyframe": keyframe,
+            "drift": round(keyframe - trim_times[point], 6),
+        }
+    return drift
+
+
+def snap_trim_times(trim_times, drift):
+    """Returns trim_times moved to the nearest keyframes found in drift."""
+    snapped = trim_times.copy()
+    for point in drift:
+        snapped[point] = drift[point]["keyframe"]
+    # start and end can snap onto the same keyframe
+    if snapped["end"] is not None and snapped["end"] <= snapped["start"]:
+        snapped["end"] = trim_times["end"]
+    return snapped
+
+
+def ask_snap(videos, trim_times):
+    """
+    Reports how far trim_times are from the nearest keyframes of videos,
+    as stream copies can only cut on keyframes, and asks whether to snap
+    them to those keyframes. Returns True if so.
+    """
+    durations = [duration(info) for info in probe_videos(videos, cached=True)]
+    drift = trim_drift(videos, durations, trim_times)
+    if all(abs(d["drift"]) < 0.001 for d in drift.values()):
+        return False
+    for point, d in drift.items():
+        print(
+            f"Trim {point} {d['requested']:.3f}s is {abs(d['drift']):.3f}s "
+            f"{'before' if d['drift'] > 0 else 'after'} the nearest keyframe "
+            f"({d['keyframe']:.3f}s)."
+        )
+    return pyask.yes_no("Snap trim times to the nearest keyframes?", default="yes")
+
+
+def video_stream_info(filename, count_frames=False):
+    """
+    Returns dict of the first video stream's duration and average frame
+    rate, plus its frame count (slow, reads whole file) if count_frames.
+    """
+    stream = json.loads(
+        run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0"]
+            + (["-count_packets"] if count_frames else [])
+            + [
+                "-show_entries",
+                "stream=duration,avg_frame_rate,nb_read_packets:format=duration",
+                "-print_format",
+                "json",
+                filename,
+            ]
+        )
+    )
+    info = stream["streams"][0]
+    num, den = info.get("avg_frame_rate", "0/0").split("/")
+    return {
+        "duration": float(
+            info.get("duration", stream["format"].get("duration", "nan"))
+        ),
+        "frame_rate": float(num) / float(den) if float(den) else 0,
+        "frames": int(info.get("nb_read_packets", -1)),
+    }
+
+
+def split_points(keyframes, length, segments):
+    """
+    Returns keyframe times that split a video, length seconds long, into
+    about segments equally long parts.
+    """
+    points = []
+    for i in range(1, segments):
+        target = length * i / segments
+        nearest = min(keyframes, key=lambda k: abs(k - target), default=0)
+        if nearest > (points[-1] if points else 0):
+            points.append(nearest)
+    return points
+
+
+def other_stream_args(keep_audio=True, keep_metadata=True, input_index=1):
+    """
+    Returns ffmpeg options selecting which non-video streams of input
+    input_index to output. Mirrors map_args().
+    """
+    n = str(input_index)
+    if not keep_metadata:
+        return ["-map", n + ":a?"] if keep_audio else []
+    return ["-map", n, "-map", "-" + n + ":v"] + (
+        [] if keep_audio else ["-map", "-" + n + ":a"]
+    )
+
+
+def smart_trim(infile, outfile, trim_times, keep_audio=True, keep_metadata=True):
+    """
+    Trims infile to exactly trim_times, rather than to the nearest
+    i-frames, in outfile. Only the partial groups of pictures (GOPs) at
+    the start and end of the trim are re-encoded; the whole GOPs between
+    them are stream copied. Returns outfile.
+    """
+    start = trim_times["start"]
+    end = trim_times["end"]
+    stream = video_stream_info(infile)
+    if end is None:
+        end = stream["duration"]
+    keyframes = [k for k in keyframe_times(infile) if start <= k <= end]
+    encode_args = normalize_args(stream_format(ffprobe(infile)), ".mkv")
+    # (start, end, stream copy?) of each piece of the trimmed video
+    bounds = [(start, end, False)]
+    if keyframes:
+        bounds = [
+            (start, keyframes[0], False),
+            (keyframes[0], keyframes[-1], True),
+            (keyframes[-1], end, False),
         ]
+    # seek a touch past keyframes, so rounding of their times can not
+    # make the copy start on the keyframe before
+    nudge = 0.5 / stream["frame_rate"] if stream["frame_rate"] else 0.001
+    piecedir = mkdtemp(dir=os.path.dirname(outfile) or ".")
+    try:
+        pieces = []
+        for n, (piece_start, piece_end, copy) in enumerate(bounds):
+            if piece_end <= piece_start:
+                continue
+            piece = os.path.join(piecedir, f"piece{n}.mkv")
+            if copy:
+                seek = piece_start + nudge
+                # stream copies stop on decoding, not presentation, times
+                # so could include frames past piece_end. Instead, split
+                # on the keyframe at piece_end and keep the 1st segment
+                run(
+                    ["ffmpeg", "-ss", str(seek), "-i", infile]
+                    + ["-t", str(piece_end - seek + 1), "-map", "0:v:0"]
+                    + ["-c", "copy", "-avoid_negative_ts", "make_zero"]
+                    + ["-f", "segment", "-segment_times"]
+                    + [str(piece_end - seek - nudge)]
+                    + [os.path.join(piecedir, f"piece{n}_%d.mkv")],
+                    stage="smart_trim",
+                )
+                os.rename(os.path.join(piecedir, f"piece{n}_0.mkv"), piece)
+            else:
+                run(
+                    ["ffmpeg", "-ss", str(piece_start), "-i", infile]
+                    + ["-t", str(piece_end - piece_start), "-map", "0:v:0"]
+                    + encode_args
+                    + [piece],
+                    stage="smart_trim",
+                )
+            pieces.append(piece)
+        concat_filesname = os.path.join(piecedir, "pieces.txt")
+        with open(concat_filesname, "w") as concat_files:
+            for piece in pieces:
+                concat_files.write(f"file '{os.path.basename(piece)}'\n")
+        run(
+            ["ffmpeg", "-f", "concat", "-safe", "0", "-i", concat_filesname]
+            # other streams, e.g. audio, are trimmed from infile
+            + ["-ss", str(start), "-t", str(end - start), "-i", infile]
+            + ["-map", "0:v"]
+            + other_stream_args(keep_audio, keep_metadata)
+            + ["-c", "copy"]
+            + ([] if keep_metadata else strip_metadata_args)
+            + [outfile],
+            stage="smart_trim",
+        )
+    finally:
+        rmtree(piecedir)
+    return outfile
+
+
+def x264(infile, outfile, keep_audio=True, keep_metadata=True):
+    """Transcodes infile's video to h264 in outfile in a single ffmpeg run."""
+    run(
+        ["ffmpeg", "-i", infile]
+        + map_args(keep_audio, keep_metadata)
+        + x264_args
+        + ([] if keep_metadata else strip_metadata_args)
+        + [outfile]
     )
     return outfile
 
 
-def mp4(infile, outfile):
-    """If needed, takes infile and remuxes/transcodes to mp4 outfile."""
-    if infile[-4:].casefold() == ".mp4":
-        return infile
+def check_segmented_x264(segments, infile, outfile):
+    """
+    Checks that the segmented encode of infile, outfile, has the same
+    frame count and duration as a single-pass encode would have, i.e.,
+    those of infile. Raises RuntimeError if not.
+    """
+    frames = sum(video_stream_info(s, count_frames=True)["frames"] for s in segments)
+    og = video_stream_info(infile)
+    final = video_stream_info(outfile, count_frames=True)
+    if final["frames"] != frames:
+        raise RuntimeError(
+            f"Segmented encode has {final['frames']} frames, expected {frames}."
+        )
+    # allow for rounding of timestamps at each segment boundary
+    tolerance = (len(segments) + 1) / og["frame_rate"] if og["frame_rate"] else 1
+    if abs(final["duration"] - og["duration"]) > tolerance:
+        raise RuntimeError(
+            f"Segmented encode lasts {final['duration']}s, "
+            f"expected {og['duration']}s."
+        )
+
+
+def segmented_x264(infile, outfile, workers, keep_audio=True, keep_metadata=True):
+    """
+    Transcodes infile's video to h264 in outfile by splitting it on
+    keyframes into segments, encoding workers segments at a time, then
+    joining them (with infile's other streams) without re-encoding.
+    """
+    length = video_stream_info(infile)["duration"]
+    points = split_points(keyframe_times(infile), length, workers)
+    if not points:
+        return x264(infile, outfile, keep_audio, keep_metadata)
+    segdir = mkdtemp(dir=os.path.dirname(outfile) or ".")
     try:
-        # try simple remux first
         run(
             [
                 "ffmpeg",
                 "-i",
                 infile,
-                # use all streams
                 "-map",
-                "0",
+                "0:v:0",
                 "-c",
                 "copy",
-                outfile,
-            ]
+                # segment muxer splits on the keyframes at these times
+                "-f",
+                "segment",
+                "-segment_times",
+                ",".join(map(str, points)),
+                "-reset_timestamps",
+                "1",
+                os.path.join(segdir, "segment%04d.mkv"),
+            ],
+            stage="segmented_x264",
+        )
+        segments = sorted(
+            os.path.join(segdir, f) for f in os.listdir(segdir) if f[:7] == "segment"
+        )
+        # named afresh, as segdir's path could hold "segment" too
+        encoded = [
+            os.path.join(segdir, "encoded%04d.mkv" % i) for i in range(len(segments))
+        ]
+        # split cores between the encoders rather than each using them all
+        threads = str(max(1, (os.cpu_count() or 1) // workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(
+                executor.map(
+                    lambda seg, enc: run(
+                        ["ffmpeg", "-i", seg, "-map", "0:v"]
+                        + x264_args
+                        + ["-threads", threads, enc],
+                        stage="segmented_x264",
+                        progress=False,
+                    ),
+                    segments,
+                    encoded,
+                )
+            )
+        concat_filesname = os.path.join(segdir, "encoded.txt")
+        with open(concat_filesname, "w") as concat_files:
+            for enc in encoded:
+                concat_files.write(f"file '{os.path.basename(enc)}'\n")
+        run(
+            ["ffmpeg", "-f", "concat", "-safe", "0", "-i", concat_filesname]
+            + ["-i", infile, "-map", "0:v"]
+            + other_stream_args(keep_audio, keep_metadata)
+            + ["-c:v", "copy"]
+            + ([] if keep_metadata else strip_metadata_args)
+            + [outfile],
+            stage="segmented_x264",
         )
+        check_segmented_x264(segments, infile, outfile)
+    finally:
+        rmtree(segdir)
+    return outfile
+
+
+def transcode(infile, outfile, workers=1, keep_audio=True, keep_metadata=True):
+    """
+    Transcodes infile's video to h264 in outfile, in segments across
+    workers encoders if workers > 1, falling back to a single encode if
+    that fails.
+    """
+    if workers > 1:
+        try:
+            return segmented_x264(infile, outfile, workers, keep_audio, keep_metadata)
+        except RuntimeError as err:
+            print(f"Segmented transcode failed with:\n{err}")
+            print("Transcoding in a single pass instead.")
+            if os.path.exists(outfile):
+                os.remove(outfile)
+    return x264(infile, outfile, keep_audio, keep_metadata)
+
+
+def mp4(infile, outfile, workers=1):
+    """If needed, takes infile and remuxes/transcodes to mp4 outfile."""
+    if infile[-4:].casefold() == ".mp4":
+        return infile
+    try:
+        # try simple remux first
+        run(["ffmpeg", "-i", infile, "-map", "0", "-c", "copy", outfile])
     except RuntimeError as err:
         print(f"Remux failed with:\n{err}")
         print("Transcoding to h264 instead (this will take a while!).")
-        run(
-            [
-                "ffmpeg",
-                "-i",
-                infile,
-                # use all streams
-                "-map",
-                "0",
-                "-c:v",
-                # use h264 at nearly lossless conversion crf setting
-                "libx264",
-                "-preset",
-                "slow",
-                "-crf",
-                "18",
-                outfile,
-            ]
-        )
+        transcode(infile, outfile, workers)
     return outfile
 
 
 def strip_metadata(infile, outfile):
     """Strips metadata from infile and places stripped video in
     outfile. Returns outfile's path."""
+    # just copy streams, do not transcode (much faster and lossless)
     run(
-        [
-            "ffmpeg",
-            # set input video
-            "-i",
-            infile,
-            # select all video streams
-            "-map",
-            "0:v",
-            # select all audio streams if present
-            "-map",
-            "0:a?",
-            # just copy streams, do not transcode (much faster and lossless)
-            "-c",
-            "copy",
-            # strip global metadata for the video container
-            "-map_metadata",
-            "-1",
-            # strip metadata for video stream
-            "-map_metadata:s:v",
-            "-1",
-            # strip metadata for audio stream
-            "-map_metadata:s:a",
-            "-1",
-            # remove any chapter information
-            "-map_chapters",
-            "-1",
-            # remove any disposition info
-            "-disposition",
-            "0",
-            outfile,
-        ]
+        ["ffmpeg", "-i", infile]
+        + map_args(keep_metadata=False)
+        + ["-c", "copy"]
+        + strip_metadata_args
+        + [outfile]
     )
     return outfile
 
 
+def plan_passes(
+    videos, durations, trim_times, args, workdir, extension, transcode=False
+):
+    """
+    Plans the ffmpeg passes needed to turn videos into the final video
+    with extension. Returns a list of passes, dicts holding the stages
+    each pass performs, its ffmpeg command, and its output filename.
+
+    Everything is done in one stream copying pass. If transcode is True
+    (b/c the remux to mp4 failed), it instead uses a stream copy pass to
+    concat and trim, keeping trims on the same i-frames as a remux
+    would have, then a second pass to transcode into the final video.
+    If args.exact_trim, the first pass only concats. The second pass
+    then either smart trims (see smart_trim()) or, when transcoding,
+    trims precisely as it transcodes.
+    """
+    next_name = partial(random_videoname, directory=workdir)
+    og_extension = os.path.splitext(videos[0])[1].casefold()
+    remux = not args.keep_format and og_extension != ".mp4"
+    exact = args.exact_trim and is_trimmed(trim_times)
+    passes = []
+    stages = ["concat"] if len(videos) > 1 else []
+    if is_trimmed(trim_times) and not exact:
+        stages.append("trim")
+    if (transcode or exact) and stages:
+        copy_trim_times = {"start": 0, "end": None} if exact else trim_times
+        trim_in, trim_out = trim_args(copy_trim_times, concat=len(videos) > 1)
+        outfile = next_name(og_extension)
+        passes.append(
+            {
+                "stages": stages,
+                "command": ["ffmpeg"]
+                + trim_in
+                + input_args(videos, workdir, durations, copy_trim_times)
+                + ["-map", "0", "-c", "copy"]
+                + trim_out
+                + [outfile],
+                "output": outfile,
+            }
+        )
+        videos, stages = [outfile], []
+        if not exact:
+            trim_times = {"start": 0, "end": None}
+    if exact:
+        stages.append("trim")
+    if not args.keep_audio:
+        stages.append("remove_audio")
+    if remux:
+        stages.append("mp4")
+    if not args.keep_metadata:
+        stages.append("strip_metadata")
+    outfile = next_name(extension)
+    if exact and not transcode:
+        passes.append(
+            {
+                "stages": stages,
+                "smart_trim": {"input": videos[0], "trim_times": trim_times},
+                "output": outfile,
+            }
+        )
+        return passes
+    trim_in, trim_out = trim_args(trim_times, concat=len(videos) > 1)
+    passes.append(
+        {
+            "stages": stages,
+            "command": ["ffmpeg"]
+            + trim_in
+            + input_args(videos, workdir, durations, trim_times)
+            + map_args(args.keep_audio, args.keep_metadata)
+            + (x264_args if transcode else ["-c", "copy"])
+            + trim_out
+            + ([] if args.keep_metadata else strip_metadata_args)
+            + [outfile],
+            "output": outfile,
+        }
+    )
+    if transcode and not exact and args.encode_workers > 1:
+        # command is then what the segmented encode is equivalent to
+        passes[-1]["segmented"] = {
+            "input": videos[0],
+            "workers": args.encode_workers,
+        }
+    return passes
+
+
+def remove_files(files):
+    """Removes files, if they exist."""
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def file_identity(filename):
+    """
+    Returns identity of filename's content, a hash of its path, size,
+    and modification time, for cache keys.
+    """
+    stat = os.stat(filename)
+    ident = f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return sha256(ident.encode()).hexdigest()
+
+
+def canonical(obj, identities, output):
+    """
+    Returns obj, part of a pass, with its files swapped for identities
+    of their content (from identities or, for concat lists, the list
+    itself) and output for its extension, so runs with the same inputs
+    and parameters give the same result.
+    """
+    if isinstance(obj, list):
+        return [canonical(o, identities, output) for o in obj]
+    if isinstance(obj, dict):
+        return {k: canonical(v, identities, output) for k, v in obj.items()}
+    if not isinstance(obj, str):
+        return obj
+    if obj == output:
+        return os.path.splitext(output)[1]
+    path = os.path.abspath(obj)
+    if path in identities:
+        return identities[path]
+    if obj.endswith(".txt") and os.path.isfile(obj):
+        with open(obj) as concat_files:
+            return [
+                identities.get(line[6:-1], line) if line.startswith("file '") else line
+                for line in concat_files.read().splitlines()
+            ]
+    return obj
+
+
+def pass_keys(passes, identities):
+    """
+    Returns list of cache keys of passes, each a hash of the pass's
+    parameters and the identities of its inputs. A pass's output takes
+    its key as its identity (added to identities), so later passes'
+    keys chain on earlier ones.
+    """
+    keys = []
+    for ffmpeg_pass in passes:
+        described = {k: v for k, v in ffmpeg_pass.items() if k != "output"}
+        described = canonical(described, identities, ffmpeg_pass["output"])
+        key = sha256(json.dumps(described, sort_keys=True).encode()).hexdigest()
+        identities[os.path.abspath(ffmpeg_pass["output"])] = key
+        keys.append(key)
+    return keys
+
+
+def reflink_or_copy(src, dst):
+    """Copies src to dst, sharing src's blocks (a reflink) if the
+    filesystem can, so it costs no space until either is changed."""
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    copyfile(src, dst)
+
+
+def link_or_copy(src, dst, link=True):
+    """Hardlinks src to dst if link, otherwise (or if they are on
+    different filesystems) reflinks or copies it."""
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    reflink_or_copy(src, dst)
+
+
+def cache_entry(cache, key, filename):
+    """Returns filename of the entry in cache for key's output filename."""
+    return os.path.join(cache, key + os.path.splitext(filename)[1])
+
+
+def cache_restore(cache, key, filename, link=True):
+    """
+    Restores key's output from cache to filename, hardlinked if link
+    (only for intermediates that never leave the workdir, as a hardlink
+    shares later changes to either), else reflinked or copied. Returns
+    True if it was in the cache.
+    """
+    entry = cache_entry(cache, key, filename)
+    try:
+        link_or_copy(entry, filename, link)
+    except OSError:
+        remove_files([filename])
+        return False
+    # entries are evicted least recently used first
+    os.utime(entry)
+    return True
+
+
+def cache_store(cache, key, filename, stages, link=True):
+    """Stores filename, the output of stages, in cache as key's output,
+    hardlinked if link (see cache_restore()), else reflinked or copied."""
+    entry = cache_entry(cache, key, filename)
+    # link then rename so a concurrent run never reads half an entry
+    tmp_name = f"{entry}.{uuid4().hex}.tmp"
+    try:
+        link_or_copy(filename, tmp_name, link)
+        os.replace(tmp_name, entry)
+        with open(os.path.join(cache, key + ".json"), "w") as entry_info:
+            json.dump({"directory": os.getcwd(), "stages": stages}, entry_info)
+    except OSError as err:
+        remove_files([tmp_name])
+        stderr(f"Could not cache {filename}: {err}")
+
+
+def cache_entries(cache):
+    """
+    Returns list of dicts of cache's entries' key, filename, size, last
+    use, and the stages that made them, least recently used first.
+    """
+    entries = []
+    with os.scandir(cache) as dir_entries:
+        for dir_entry in dir_entries:
+            key, extension = os.path.splitext(dir_entry.name)
+            if extension in (".json", ".tmp") or not dir_entry.is_file():
+                continue
+            try:
+                stat = dir_entry.stat()
+                with open(os.path.join(cache, key + ".json")) as entry_info:
+                    stages = json.load(entry_info).get("stages", [])
+            except (OSError, ValueError):
+                stages = []
+            entries.append(
+                {
+                    "key": key,
+                    "filename": dir_entry.path,
+                    "size": stat.st_size,
+                    "last_used": stat.st_mtime,
+                    "stages": stages,
+                }
+            )
+    return sorted(entries, key=lambda e: e["last_used"])
+
+
+def remove_cache_entry(entry):
+    """Removes a cache entry, from cache_entries(), and its info."""
+    remove_files([entry["filename"], os.path.splitext(entry["filename"])[0] + ".json"])
+
+
+def evict_cache(cache, max_bytes):
+    """Removes least recently used entries in cache until under max_bytes."""
+    entries = cache_entries(cache)
+    total = sum(e["size"] for e in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        # another run may have evicted it already
+        try:
+            remove_cache_entry(entry)
+        except FileNotFoundError:
+            pass
+        total -= entry["size"]
+
+
+def print_cache(cache, max_bytes):
+    """Prints cache's entries, least recently used first, and its size."""
+    entries = cache_entries(cache)
+    for entry in entries:
+        last_used = datetime.fromtimestamp(entry["last_used"]).strftime(
+            "%Y-%m-%d %H:%M"
+        )
+        print(
+            f"{entry['key'][:16]}  {entry['size'] / 1e6:10.1f} MB  {last_used}  "
+            + "+".join(entry["stages"])
+        )
+    total = sum(e["size"] for e in entries)
+    print(
+        f"{len(entries)} entries, {total / 1e6:.1f} MB of {max_bytes / 1e6:.1f} MB "
+        f'in "{cache}".'
+    )
+
+
+def clear_cache(cache):
+    """Removes every entry in cache."""
+    for entry in cache_entries(cache):
+        remove_cache_entry(entry)
+
+
+def run_passes(passes, args, identities=None):
+    """
+    Runs the ffmpeg command of each pass. Removes each intermediate
+    video as soon as the next pass has read it.
+    If args.cache, each pass's output is cached and passes are skipped
+    from the last one found in the cache, keyed on its parameters and
+    identities (dict of input filename to file_identity()).
+    Returns final output filename.
+    """
+    start = 0
+    last = len(passes) - 1
+    if args.cache:
+        keys = pass_keys(passes, identities)
+        for n in reversed(range(len(passes))):
+            # the last pass's output is delivered, so must not share the entry
+            if cache_restore(args.cache, keys[n], passes[n]["output"], n < last):
+                print(f"Reusing cached {'+'.join(passes[n]['stages'])}.")
+                start = n + 1
+                break
+    for n, ffmpeg_pass in enumerate(passes[start:], start):
+        if "segmented" in ffmpeg_pass:
+            transcode(
+                ffmpeg_pass["segmented"]["input"],
+                ffmpeg_pass["output"],
+                ffmpeg_pass["segmented"]["workers"],
+                args.keep_audio,
+                args.keep_metadata,
+            )
+        elif "smart_trim" in ffmpeg_pass:
+            smart_trim(
+                ffmpeg_pass["smart_trim"]["input"],
+                ffmpeg_pass["output"],
+                ffmpeg_pass["smart_trim"]["trim_times"],
+                args.keep_audio,
+                args.keep_metadata,
+            )
+        else:
+            run(ffmpeg_pass["command"], stage="+".join(ffmpeg_pass["stages"]))
+        if args.cache:
+            cache_store(
+                args.cache,
+                keys[n],
+                ffmpeg_pass["output"],
+                ffmpeg_pass["stages"],
+                n < last,
+            )
+        if n:
+            remove_files([passes[n - 1]["output"]])
+    return passes[-1]["output"]
+
+
+def process_videos(
+    videos,
+    durations,
+    trim_times,
+    args,
+    workdir,
+    extension,
+    consumed=(),
+    identities=None,
+):
+    """
+    Runs the planned passes to make the final video, falling back to
+    transcoding if remuxing fails. Files in consumed are removed once
+    the final video is made, as the fallback replans from them.
+    identities are for the cache, see run_passes(). Returns tuple of
+    final video filename and the passes that made it.
+    """
+    plan = partial(plan_passes, videos, durations, trim_times, args, workdir)
+    passes = plan(extension)
+    try:
+        final_video = run_passes(passes, args, identities)
+    except RuntimeError as err:
+        if "mp4" not in passes[-1]["stages"]:
+            raise
+        print(f"Remux failed with:\n{err}")
+        print("Transcoding to h264 instead (this will take a while!).")
+        # don't leave the failed remux taking up space
+        remove_files(p["output"] for p in passes)
+        passes = plan(extension, transcode=True)
+        final_video = run_passes(passes, args, identities)
+    remove_files(consumed)
+    return (final_video, passes)
+
+
+def duration(info):
+    """Returns duration, in seconds, from ffprobe output info."""
+    return float(info["format"].get("duration", 0))
+
+
+def combine_infos(videos, infos):
+    """
+    Takes ffprobe output, infos, for each of videos. Returns dict of
+    ffprobe's output as if videos had been concatenated into one video.
+    """
+    if len(infos) == 1:
+        return infos[0]
+    info = deepcopy(infos[0])
+    info["format"]["filename"] = "concat:" + "|".join(videos)
+    info["format"]["duration"] = "{:.6f}".format(sum(map(duration, infos)))
+    return info
+
+
 def save_json(obj, logname="log.json"):
     """Save obj to logname as json b/c python json.dump() doesn't add newline."""
     with open(logname, "w") as logfile:
@@ -364,7 +1610,16 @@ def save_json(obj, logname="log.json"):
 
 def current_datetime():
     """Returns string of current date and time."""
-    return datetime.today().strftime("%Y%m%d%H%M")
+    return datetime.today().strftime("%Y%m%d%H%M%S")
+
+
+def unique_logname(prefix, extension=".json"):
+    """
+    Returns filename of prefix, the current date and time, and a random
+    suffix, so jobs or batches started at the same time (even on the
+    same directory) don't overwrite each other's logs.
+    """
+    return f"{prefix}{current_datetime()}_{uuid4().hex[:8]}{extension}"
 
 
 def random_videoname(extension=".mp4", directory=None):
@@ -374,49 +1629,245 @@ def random_videoname(extension=".mp4", directory=None):
     return videoname
 
 
-def main():
-    """Processes a directory of video files into a single mp4 video."""
-    args = validate_args(parser().parse_args())
-    os.chdir(args.directory)
-    videos = [f for f in sorted(os.listdir()) if is_video(f)]
-    if len(videos) == 0:
-        stderr_and_exit(f"No video files found in '{os.getcwd()}'.")
-    workdir = make_workdir()
-    # gen random names for videos to live in temporary "workdir"
-    next_name = partial(random_videoname, directory=workdir)
+def directory_videos():
+    """Returns sorted list of videos in current directory."""
+    return [f for f in sorted(os.listdir()) if is_video(f)]
+
+
+def process_directory(videos, trim_times, args):
+    """
+    Processes videos, in the current directory, into a single video per
+    args and trim_times. Returns the final video's filename.
+    """
     og_extension = os.path.splitext(videos[0])[1].casefold()
-    final_video = args.output if args.output is not None else random_videoname()
+    final_video = args.output
+    if final_video is None:
+        final_video = random_videoname(og_extension if args.keep_format else ".mp4")
     final_extension = os.path.splitext(final_video)[1].casefold()
-    # need a default trim time
-    trim_times = {"start": 0, "end": None}
+    del telemetry[:]
+    identities = None
+    if args.cache:
+        identities = {os.path.abspath(v): file_identity(v) for v in videos}
+    infos = probe_videos(videos, cached=True)
+    drift = {}
+    if args.snap and is_trimmed(trim_times) and not args.exact_trim:
+        drift = trim_drift(videos, [duration(info) for info in infos], trim_times)
+        trim_times = snap_trim_times(trim_times, drift)
+    og_info = combine_infos(videos, infos)
+    # intermediates are deleted once used, so at most an input and
+    # output of a pass exist at once, the 2nd for a multi-pass plan, as
+    # well as any normalized videos, kept until the plan is done
+    needed = estimate_size(infos, trim_times) * (
+        (2 if args.exact_trim else 1.1) + (len(videos) > 1)
+    )
+    workdir = make_workdir(pick_workdir_parent(args.workdir or ["."], needed))
     try:
-        inprocess_video, video_count = concat(videos, next_name(og_extension), workdir)
-        og_info = ffprobe(inprocess_video)
-        if not args.no_trim:
-            inprocess_video, trim_times = trim(inprocess_video, next_name(og_extension))
-        if not args.keep_audio:
-            inprocess_video = remove_audio(inprocess_video, next_name(og_extension))
-        if not args.keep_format:
-            inprocess_video = mp4(inprocess_video, next_name(".mp4"))
-        if not args.keep_metadata:
-            inprocess_video = strip_metadata(
-                inprocess_video, next_name(final_extension)
+        normalized = {}
+        if len(videos) > 1:
+            videos, infos, normalized = normalize(
+                videos, infos, workdir, args.encode_workers, args.cache, identities
             )
-        os.rename(inprocess_video, final_video)
+        inprocess_video, passes = process_videos(
+            videos,
+            [duration(info) for info in infos],
+            trim_times,
+            args,
+            workdir,
+            final_extension,
+            consumed=normalized.values(),
+            identities=identities,
+        )
+        move(inprocess_video, final_video)
         final_info = ffprobe(final_video)
         if not args.no_log:
             save_json(
                 {
-                    "video_count": video_count,
+                    "video_count": len(videos),
                     "original": og_info,
                     "final": final_info,
                     "trim_times": trim_times,
+                    "keyframe_drift": drift,
+                    "normalized": normalized,
+                    "plan": passes,
+                    "telemetry": telemetry,
                 },
-                logname="log_" + current_datetime() + ".json",
+                logname=unique_logname("log_"),
             )
+    finally:
+        rmtree(workdir)
+        if args.cache:
+            evict_cache(args.cache, args.cache_size * 1e9)
+    return final_video
+
+
+def is_true(value):
+    """Checks if manifest value (bool or str, e.g. "yes") is true."""
+    if isinstance(value, str):
+        return value.strip().casefold() in ("1", "true", "t", "yes", "y")
+    return bool(value)
+
+
+def to_seconds(value):
+    """
+    Returns manifest time value (number or HH:MM:SS str, either with
+    optional fractional seconds) in seconds.
+    """
+    if isinstance(value, str):
+        whole, point, fraction = value.partition(".")
+        if point and ":" in whole:
+            if fraction and not fraction.isdigit():
+                raise ValueError(f"{value} is not a valid time.")
+            return pyask.numeric.to_seconds(whole) + float("0." + fraction)
+        if point:
+            return float(value)
+        return pyask.numeric.to_seconds(value)
+    return value
+
+
+def read_manifest(manifest):
+    """
+    Reads manifest, a json file with a list of objects or csv file with
+    a header, into a list of dicts, one per directory to process.
+    """
+    with open(manifest, newline="") as manifile:
+        if manifest.casefold().endswith(".json"):
+            entries = json.load(manifile)
+        else:
+            entries = list(csv.DictReader(manifile))
+    for entry in entries:
+        # csv can only hold the file order as a "|" separated string
+        if isinstance(entry.get("order"), str):
+            entry["order"] = [f for f in entry["order"].split("|") if f]
+    return entries
+
+
+def job_args(entry, manifest_dir=".", defaults=None):
+    """
+    Takes an entry from a manifest and returns tuple of args (like those
+    from the command line), file order, and trim times for the job.
+    Options not in the entry come from defaults (the batch's args).
+    """
+    args = deepcopy(defaults) if defaults is not None else parser().parse_args([])
+    args.directory = os.path.abspath(os.path.join(manifest_dir, entry["directory"]))
+    args.output = entry.get("output") or None
+    for flag in (
+        "no_log",
+        "keep_audio",
+        "keep_format",
+        "keep_metadata",
+        "exact_trim",
+        "snap",
+    ):
+        setattr(args, flag, is_true(entry.get(flag, getattr(args, flag))))
+    if entry.get("encode_workers") not in (None, ""):
+        args.encode_workers = max(1, int(entry["encode_workers"]))
+    if entry.get("workdir") not in (None, ""):
+        # "|" separates fallbacks, as with the file order
+        args.workdir = [
+            os.path.abspath(os.path.join(manifest_dir, workdir))
+            for workdir in entry["workdir"].split("|")
+        ]
+    trim_times = {"start": 0, "end": None}
+    if entry.get("start") not in (None, ""):
+        trim_times["start"] = to_seconds(entry["start"])
+    if entry.get("end") not in (None, ""):
+        trim_times["end"] = to_seconds(entry["end"])
+    if trim_times["end"] is not None and trim_times["start"] >= trim_times["end"]:
+        raise ValueError("Start time must come before end time.")
+    return (args, entry.get("order") or None, trim_times)
+
+
+def run_job(entry, manifest_dir=".", defaults=None):
+    """
+    Processes the directory of a manifest entry without asking any
+    questions. Returns dict summarising how the job went.
+    """
+    global show_progress_bar
+    show_progress_bar = False
+    summary = {"directory": entry.get("directory"), "status": "failed"}
+    start_time = time.perf_counter()
+    try:
+        args, videos, trim_times = job_args(entry, manifest_dir, defaults)
+        check_args(args)
+        use_probe_cache(args)
+        os.chdir(args.directory)
+        if videos is None:
+            videos = directory_videos()
+        if len(videos) == 0:
+            raise ValueError(f"No video files found in '{args.directory}'.")
+        input_bytes = sum(os.path.getsize(video) for video in videos)
+        final_video = process_directory(videos, trim_times, args)
+        summary.update(
+            status="ok",
+            final_video=os.path.join(args.directory, final_video),
+            input_bytes=input_bytes,
+        )
+    except (KeyError, OSError, RuntimeError, ValueError) as err:
+        summary["error"] = str(err)
+    summary["wall_time"] = time.perf_counter() - start_time
+    if "input_bytes" in summary:
+        summary["throughput_mb_s"] = summary["input_bytes"] / 1e6 / summary["wall_time"]
+    return summary
+
+
+def run_batch(args):
+    """
+    Processes every directory in the args.batch manifest, args.jobs
+    directories at a time, with args as the default options. Saves a
+    json summary of each job. Returns True if all jobs succeeded.
+    """
+    manifest = args.batch
+    entries = read_manifest(manifest)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    summaries = []
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for summary in executor.map(
+            partial(run_job, manifest_dir=manifest_dir, defaults=args), entries
+        ):
+            if summary["status"] == "ok":
+                print(f'"{summary["directory"]}" saved as "{summary["final_video"]}".')
+            else:
+                stderr(f'"{summary["directory"]}" failed:\n{summary["error"]}')
+            summaries.append(summary)
+    summaryname = unique_logname(os.path.splitext(manifest)[0] + "_summary_")
+    save_json(
+        {"wall_time": time.perf_counter() - start_time, "jobs": summaries},
+        logname=summaryname,
+    )
+    print(f'Batch summary saved as "{summaryname}".')
+    return all(summary["status"] == "ok" for summary in summaries)
+
+
+def main():
+    """Processes a directory of video files into a single mp4 video."""
+    args = validate_args(parser().parse_args())
+    if args.cache_list or args.cache_clear:
+        if args.cache_clear:
+            clear_cache(args.cache)
+        print_cache(args.cache, args.cache_size * 1e9)
+        return
+    if args.batch is not None:
+        if not run_batch(args):
+            sys.exit(1)
+        return
+    use_probe_cache(args)
+    os.chdir(args.directory)
+    videos = directory_videos()
+    if len(videos) == 0:
+        stderr_and_exit(f"No video files found in '{os.getcwd()}'.")
+    # ask all questions up front so ffmpeg can do everything in one pass
+    videos = ask_video_order(videos)
+    # need a default trim time
+    trim_times = {"start": 0, "end": None}
+    if not args.no_trim:
+        trim_times = ask_trim_times()
+    try:
+        if is_trimmed(trim_times) and not (args.exact_trim or args.snap):
+            args.snap = ask_snap(videos, trim_times)
+        final_video = process_directory(videos, trim_times, args)
     except (OSError, RuntimeError) as err:
         stderr_and_exit(err)
-    rmtree(workdir)
     print(f'Final video saved as "{os.path.join(args.directory, final_video)}".')
 
 
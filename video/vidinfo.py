@@ -23,13 +23,52 @@ installed.
 """
 
 import argparse
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import csv
+from datetime import datetime
 from functools import partial
 import json
+from math import floor, sqrt
 import os
 from shutil import which
+import sqlite3
 import subprocess
 import sys
+from tempfile import TemporaryFile
+
+import containers
+import probecache
+import walker
+
+# extensions of videos to look for
+vid_exts = ("avi", "flv", "m4v", "mkv", "mpg", "mov", "mp4", "webm", "wmv")
+# ffprobe options (bar the filename) used to get video information
+ffprobe_args = [
+    "ffprobe",
+    "-hide_banner",
+    "-select_streams",
+    "v",
+    "-show_entries",
+    "format=filename,format_name,duration:format_tags=:"
+    "stream=codec_name,width,height:stream_disposition=:"
+    "stream_tags=",
+    "-print_format",
+    "json",
+]
+# ffprobe options (bar the filename) listing the 1st video stream's
+# packets, one "dts_time,size,flags" line each
+packet_args = [
+    "ffprobe",
+    "-v",
+    "error",
+    "-select_streams",
+    "v:0",
+    "-show_entries",
+    "packet=dts_time,size,flags",
+    "-print_format",
+    "csv=p=0",
+]
 
 
 def parser():
@@ -49,10 +88,84 @@ def parser():
         "-f",
         "--format",
         default="json",
-        help="Output format",
+        help="Output format (json is one object per line)",
         choices=["csv", "json", "tsv"],
     )
     prsr.add_argument("-o", "--output", help="Output filename", default="-")
+    prsr.add_argument(
+        "-j",
+        "--jobs",
+        default=8,
+        type=int,
+        help="Number of ffprobes to run at once.",
+    )
+    prsr.add_argument(
+        "-r",
+        "--ordered",
+        action="store_true",
+        default=False,
+        help="Output videos in the order found rather than as probed.",
+    )
+    prsr.add_argument(
+        "-e",
+        "--errors",
+        help="Filename for csv report of videos ffprobe failed on. If none "
+        "provided, uses vidinfo_errors_YYYYMMDDHHMM.csv (only made if any fail).",
+    )
+    prsr.add_argument(
+        "-s",
+        "--summary",
+        action="store_true",
+        default=False,
+        help="Output number of video streams, and total duration and bytes, "
+        "per codec, resolution, and container rather than each stream.",
+    )
+    prsr.add_argument(
+        "-P",
+        "--packets",
+        action="store_true",
+        default=False,
+        help="Add columns of bitrate (bits per second), GOP length (frames), "
+        "and keyframe interval (seconds) stats of each video's 1st video "
+        "stream, read from all its packets (much slower).",
+    )
+    prsr.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        default=False,
+        help="After the videos already in directory, carry on outputting "
+        "new videos as they are written until interrupted (Linux only).",
+    )
+    prsr.add_argument(
+        "-F",
+        "--ffprobe-only",
+        action="store_true",
+        default=False,
+        help="Run ffprobe on every video rather than reading MP4/MOV and "
+        "AVI headers directly.",
+    )
+    prsr.add_argument(
+        "-c",
+        "--cache",
+        default=probecache.default_path,
+        help="ffprobe output cache (a SQLite database shared with "
+        "video_processor.py). Only new or changed videos are probed.",
+    )
+    prsr.add_argument(
+        "-n",
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Probe every video rather than using the cache.",
+    )
+    prsr.add_argument(
+        "-p",
+        "--prune-cache",
+        action="store_true",
+        default=False,
+        help="Remove deleted videos from the cache before starting.",
+    )
     prsr.add_argument("directory", help="directory with videos")
     return prsr
 
@@ -65,65 +178,222 @@ def valid_args(args):
     if os.path.exists(args.output):
         print(f"{args.output} already exists. Exiting.", file=sys.stderr)
         return False
+    if args.errors is not None and os.path.exists(args.errors):
+        print(f"{args.errors} already exists. Exiting.", file=sys.stderr)
+        return False
+    if args.jobs < 1:
+        print("Need at least one job. Exiting.", file=sys.stderr)
+        return False
+    if args.watch and not sys.platform.startswith("linux"):
+        print("Watching needs Linux's inotify. Exiting.", file=sys.stderr)
+        return False
+    if args.watch and args.summary:
+        print("Can't summarise videos while watching. Exiting.", file=sys.stderr)
+        return False
     return True
 
 
-def is_video(filename):
-    """Checks if filename is a video."""
-    vid_exts = ("avi", "flv", "m4v", "mkv", "mpg", "mov", "mp4", "webm", "wmv")
-    return filename.casefold().endswith(vid_exts)
-
-
-def video_files(directory, toplevel=True):
-    """Returns all toplevel files in directory."""
-    for dirpath, _, files in os.walk(directory):
-        for f in files:
-            if is_video(f):
-                yield os.path.join(dirpath, f)
-        if toplevel:
-            break
+def video_files(directory, toplevel=True, watch=False):
+    """
+    Yields videos in directory (only its toplevel if toplevel), then if
+    watch, new videos as they are written (and None when waiting).
+    """
+    if watch:
+        return walker.watch(directory, vid_exts, not toplevel)
+    return walker.walk(directory, vid_exts, not toplevel)
 
 
 def ffprobe(filename):
-    """Call ffprobe on filename. Returns dict of ffprobe's output."""
+    """
+    Call ffprobe on filename. Returns dict of ffprobe's output. Raises
+    RuntimeError, with ffprobe's error message, if it fails.
+    """
     try:
         return json.loads(
             subprocess.run(
-                [
-                    "ffprobe",
-                    "-hide_banner",
-                    "-select_streams",
-                    "v",
-                    "-show_entries",
-                    "format=filename,format_name,duration:format_tags=:"
-                    "stream=codec_name,width,height:stream_disposition=:"
-                    "stream_tags=",
-                    "-print_format",
-                    "json",
-                    filename,
-                ],
+                ffprobe_args + [filename],
                 stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 check=True,
                 encoding="utf-8",
             ).stdout
         )
-    except subprocess.CalledProcessError:
-        print(f"ffprobe failed to process '{filename}'.", file=sys.stderr)
-        return None
+    except subprocess.CalledProcessError as err:
+        # the last line says why, earlier ones are warnings leading up to it
+        lines = err.stderr.strip().splitlines() or [f"exit status {err.returncode}"]
+        raise RuntimeError(lines[-1]) from err
+
+
+def read_headers(filename):
+    """
+    Returns dict shaped like ffprobe's output read from filename's
+    headers, falling back to ffprobe if they cannot be read confidently.
+    """
+    return containers.parse(filename) or ffprobe(filename)
+
+
+def update_stats(stats, x):
+    """
+    Adds x to stats, a list of count, mean, and sum of squared
+    differences from the mean, using Welford's algorithm.
+    """
+    stats[0] += 1
+    delta = x - stats[1]
+    stats[1] += delta / stats[0]
+    stats[2] += delta * (x - stats[1])
+
+
+def stdev(stats):
+    """Returns the sample standard deviation of stats."""
+    return sqrt(stats[2] / (stats[0] - 1)) if stats[0] > 1 else 0.0
+
+
+def packet_stats(filename):
+    """
+    Returns dict of bitrate (per second of video), GOP length (in
+    frames), and keyframe interval (in seconds) stats of filename's 1st
+    video stream, read from ffprobe's packet list line by line so memory
+    use doesn't grow with the video's length. Raises RuntimeError, with
+    ffprobe's error message, if it fails.
+    """
+    packets = 0
+    bitrates = [0, 0.0, 0.0]
+    intervals = [0, 0.0, 0.0]
+    longest_interval = 0.0
+    gop_lengths = Counter()
+    gop = 0
+    second = None
+    second_bytes = 0
+    last_keyframe = None
+    # stderr to a file, a pipe could fill up and stall ffprobe
+    with TemporaryFile() as errors:
+        with subprocess.Popen(
+            packet_args + [filename],
+            stdout=subprocess.PIPE,
+            stderr=errors,
+            encoding="utf-8",
+        ) as proc:
+            for line in proc.stdout:
+                dts, size, flags = line.rstrip("\n").split(",")[:3]
+                packets += 1
+                keyframe = flags.startswith("K")
+                if keyframe and gop:
+                    gop_lengths[gop] += 1
+                    gop = 0
+                gop += 1
+                if dts == "N/A":
+                    continue
+                dts = float(dts)
+                if keyframe:
+                    if last_keyframe is not None:
+                        update_stats(intervals, dts - last_keyframe)
+                        longest_interval = max(longest_interval, dts - last_keyframe)
+                    last_keyframe = dts
+                if second is not None and floor(dts) != second:
+                    update_stats(bitrates, second_bytes * 8)
+                    second_bytes = 0
+                second = floor(dts)
+                second_bytes += int(size)
+        if proc.returncode:
+            errors.seek(0)
+            lines = errors.read().decode(errors="replace").strip().splitlines()
+            raise RuntimeError((lines or [f"exit status {proc.returncode}"])[-1])
+    if gop:
+        gop_lengths[gop] += 1
+    # the last (partial) second would understate the bitrate
+    if not bitrates[0] and second is not None:
+        update_stats(bitrates, second_bytes * 8)
+    return {
+        "packets": packets,
+        "bitrate_mean": round(bitrates[1]),
+        "bitrate_stdev": round(stdev(bitrates)),
+        "gop_min": min(gop_lengths, default=None),
+        "gop_mean": round(packets / sum(gop_lengths.values()), 2) if packets else None,
+        "gop_max": max(gop_lengths, default=None),
+        "gop_lengths": " ".join(
+            f"{length}:{count}" for length, count in sorted(gop_lengths.items())
+        ),
+        "keyframe_interval_mean": round(intervals[1], 6),
+        "keyframe_interval_max": round(longest_interval, 6),
+    }
+
+
+def probe(filename, cache=None, headers=True, packets=False):
+    """
+    Returns tuple of filename, its ffprobe output (from cache, if given
+    and up to date, or its headers if headers) plus its packet_stats()
+    if packets, and error if failed.
+    """
+
+    def cached(query, prober):
+        """Returns prober(filename), from cache if given."""
+        if cache is None:
+            return prober(filename)
+        return probecache.cached_probe(cache, filename, query, prober)
+
+    try:
+        query = " ".join(ffprobe_args)
+        # header-parsed output is cached apart from ffprobe's, so
+        # -F/--ffprobe-only never gets it
+        if headers:
+            output = cached("headers " + query, read_headers)
+        else:
+            output = cached(query, ffprobe)
+        # may have been cached under another path to the same file
+        output["format"]["filename"] = filename
+        if packets:
+            output["packet_stats"] = cached(" ".join(packet_args), packet_stats)
+        return (filename, output, None)
+    except (OSError, RuntimeError, ValueError) as err:
+        return (filename, None, str(err))
+
+
+def probe_all(files, workers=8, ordered=False, cache=None, headers=True, packets=False):
+    """
+    Probes files, workers at a time, yielding probe() of each
+    as it finishes (or in files' order if ordered). Only a few files per
+    worker are read ahead, so files can be a generator of any length. A
+    None in files means more are a while off, so finishes those pending.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for f in files:
+            if f is None:
+                while pending:
+                    yield pending.popleft().result()
+                continue
+            pending.append(executor.submit(probe, f, cache, headers, packets))
+            if len(pending) < workers * 4:
+                continue
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def tidy_streams(output):
-    """Returns tidy dicts with info on each stream in ffprobe output."""
+    """
+    Returns tidy dicts with info on each stream in ffprobe output, plus
+    the 1st stream's packet stats (blank for the others) if any.
+    """
     for i, stream in enumerate(output["streams"]):
-        yield {"stream_num": i, **stream, **output["format"]}
+        tidy = {"stream_num": i, **stream, **output["format"]}
+        if "packet_stats" in output:
+            stats = output["packet_stats"]
+            tidy.update(stats if i == 0 else dict.fromkeys(stats))
+        yield tidy
 
 
 def save_json(dicts, fd):
-    """Save dicts to fd as json."""
+    """Save dicts to fd as newline delimited json, flushing each line."""
     for d in dicts:
-        fd.write(json.dumps(d))
-    fd.write("\n")
+        fd.write(json.dumps(d) + "\n")
+        fd.flush()
 
 
 def save_csv(dicts, fd, sep=","):
@@ -133,35 +403,148 @@ def save_csv(dicts, fd, sep=","):
             writer = csv.DictWriter(fd, fieldnames=d.keys(), delimiter=sep)
             writer.writeheader()
         writer.writerow(d)
+        fd.flush()
 
 
-def get_streams(directory, toplevel=False):
-    """Fetches ffprobe output for video files in directory."""
-    for f in video_files(directory, toplevel):
-        output = ffprobe(f)
+def get_streams(
+    directory,
+    toplevel=False,
+    workers=8,
+    ordered=False,
+    errors=None,
+    cache=None,
+    headers=True,
+    watch=False,
+    packets=False,
+):
+    """
+    Fetches ffprobe output for video files in directory, workers at a
+    time, from cache where up to date and from their headers if headers.
+    Appends tuples of filename and error of failed probes to errors, if
+    given. If watch, carries on with new videos as they are written. If
+    packets, adds bitrate and GOP stats from their packets.
+    """
+    for f, output, error in probe_all(
+        video_files(directory, toplevel, watch),
+        workers,
+        ordered,
+        cache,
+        headers,
+        packets,
+    ):
         if output is None:
+            if errors is not None:
+                errors.append((f, error))
             continue
         for stream in tidy_streams(output):
             yield stream
 
 
+def summarise(streams):
+    """
+    Yields dicts of number of streams, and total duration and bytes of
+    their files, per codec, resolution, and container of streams. Only
+    a running total per group is kept.
+    """
+    totals = {}
+    for stream in streams:
+        group = (
+            stream.get("codec_name"),
+            stream.get("width"),
+            stream.get("height"),
+            stream.get("format_name"),
+        )
+        count, duration, size = totals.get(group, (0, 0.0, 0))
+        try:
+            size += os.path.getsize(stream["filename"])
+        except OSError:
+            pass
+        duration += float(stream.get("duration", 0))
+        totals[group] = (count + 1, duration, size)
+    for group in sorted(totals, key=lambda g: tuple(str(x) for x in g)):
+        count, duration, size = totals[group]
+        yield {
+            "codec_name": group[0],
+            "width": group[1],
+            "height": group[2],
+            "format_name": group[3],
+            "count": count,
+            "duration": round(duration, 6),
+            "bytes": size,
+        }
+
+
+def save_errors(errors, filename=None):
+    """
+    Saves errors, tuples of filename and error, to csv filename (or
+    vidinfo_errors_YYYYMMDDHHMM.csv). Returns filename.
+    """
+    if filename is None:
+        filename = "vidinfo_errors_" + datetime.now().strftime("%Y%m%d%H%M") + ".csv"
+    with open(filename, "w", newline="") as errfile:
+        writer = csv.writer(errfile)
+        writer.writerow(["filename", "error"])
+        writer.writerows(errors)
+    return filename
+
+
 def main():
     """Parse args, call ffprobe on video files, and output."""
     args = parser().parse_args()
     if not valid_args(args):
         sys.exit(2)
-    streams = get_streams(args.directory, args.toplevel)
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = probecache.open_cache(args.cache)
+        except (OSError, sqlite3.Error) as err:
+            print(f"Not using cache {args.cache}: {err}", file=sys.stderr)
+    if cache is not None and args.prune_cache:
+        pruned = probecache.prune(cache)
+        print(f"Pruned {pruned} deleted videos from the cache.", file=sys.stderr)
+    errors = []
+    streams = get_streams(
+        args.directory,
+        args.toplevel,
+        args.jobs,
+        args.ordered,
+        errors,
+        cache,
+        not args.ffprobe_only,
+        args.watch,
+        args.packets,
+    )
+    if args.summary:
+        streams = summarise(streams)
     savefunc = {
         "json": save_json,
         "csv": save_csv,
         "tsv": partial(save_csv, sep="\t"),
     }
-    # don't need to open/close file if user wants stdout aka "-"
-    if args.output == "-":
-        savefunc[args.format](streams, sys.stdout)
-    else:
-        with open(args.output, "w", newline="") as outfile:
-            savefunc[args.format](streams, outfile)
+    try:
+        # don't need to open/close file if user wants stdout aka "-"
+        if args.output == "-":
+            try:
+                savefunc[args.format](streams, sys.stdout)
+            except BrokenPipeError:
+                # reader (e.g. head) has stopped, quietly drop the rest
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                sys.exit(1)
+        else:
+            with open(args.output, "w", newline="") as outfile:
+                savefunc[args.format](streams, outfile)
+    except KeyboardInterrupt:
+        # how watching is stopped
+        if not args.watch:
+            raise
+    if cache is not None:
+        print(probecache.report(cache), file=sys.stderr)
+    if errors:
+        errfile = save_errors(errors, args.errors)
+        print(
+            f"ffprobe failed on {len(errors)} videos, listed in '{errfile}'.",
+            file=sys.stderr,
+        )
 
 
 if __name__ == "__main__":
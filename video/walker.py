@@ -0,0 +1,160 @@
+# walker.py,v1.0.0
+
+# Copyright (c) 2021 Thomas Ward <thomas@thomasward.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Finds files with given extensions in a directory tree, shared by
+vidinfo.py and deidentify_videos.py. Directories are listed with
+os.scandir, several at once, so files are only told apart from
+directories by the type the listing already gave (no stat per file).
+Symlinked directories are followed, but each directory is only listed
+once so symlink loops end. On Linux, watch() carries on yielding files
+as they are written into the tree, using inotify.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+
+# inotify(7) event flags
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+# what a watched directory reports: finished/moved in files and new subdirs
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+# struct inotify_event, bar its name
+event_header = struct.Struct("iIII")
+
+
+def walk(directory, extensions, recursive=True, workers=8, on_dir=None):
+    """
+    Yields paths of files in directory (and its subdirectories if
+    recursive) ending with one of extensions (case insensitive, a tuple
+    of lowercase strings), listing workers directories at a time. Calls
+    on_dir, if given, with each directory before listing it. Unreadable
+    directories are skipped, like os.walk does.
+    """
+    seen = set()
+    lock = threading.Lock()
+
+    def scan(path):
+        """Returns tuple of lists of matching files and subdirectories."""
+        files, subdirs = [], []
+        try:
+            stat = os.stat(path)
+            # symlinks can lead back to a directory already listed
+            with lock:
+                if (stat.st_dev, stat.st_ino) in seen:
+                    return (files, subdirs)
+                seen.add((stat.st_dev, stat.st_ino))
+            if on_dir is not None:
+                on_dir(path)
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if recursive:
+                                subdirs.append(entry.path)
+                        elif entry.name.casefold().endswith(extensions):
+                            if entry.is_file():
+                                files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return (files, subdirs)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan, directory)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan, subdir))
+                yield from files
+
+
+def libc():
+    """Returns the C library, with errno kept for ctypes.get_errno()."""
+    return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def watch(directory, extensions, recursive=True, workers=8):
+    """
+    Yields walk() of directory, then paths of matching files as they
+    are finished being written into, or moved into, the tree. Yields
+    None whenever it is about to wait for more files. Never returns.
+    Linux only, raises OSError if inotify cannot be used.
+    """
+    c = libc()
+    fd = c.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    # watch descriptor to the directory it watches
+    watched = {}
+
+    def add_watch(path):
+        """Watches path, before walk() lists it so no file is missed."""
+        wd = c.inotify_add_watch(fd, os.fsencode(path), watch_mask)
+        if wd >= 0:
+            watched[wd] = path
+
+    def add_tree(path):
+        """Yields matching files in path, watching its directories."""
+        if recursive:
+            yield from walk(path, extensions, True, workers, add_watch)
+        else:
+            add_watch(path)
+            yield from walk(path, extensions, False, workers)
+
+    try:
+        yield from add_tree(directory)
+        while True:
+            if not select.select([fd], [], [], 0)[0]:
+                yield None
+            data = os.read(fd, 64 * 1024)
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = event_header.unpack_from(data, pos)
+                name = data[pos + event_header.size : pos + event_header.size + length]
+                pos += event_header.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so list the whole tree again
+                    yield from add_tree(directory)
+                    continue
+                if mask & IN_IGNORED:
+                    watched.pop(wd, None)
+                    continue
+                if wd not in watched:
+                    continue
+                path = os.path.join(watched[wd], os.fsdecode(name.rstrip(b"\0")))
+                if mask & IN_ISDIR:
+                    if recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                        yield from add_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    if path.casefold().endswith(extensions):
+                        yield path
+    finally:
+        os.close(fd)